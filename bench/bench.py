@@ -0,0 +1,190 @@
+"""
+scaling benchmark of the note parsing and of the per-keystroke actions.
+
+generates a synthetic corpus per size (see corpus.py) and times, in process -
+
+    parse_notes_cold    parsing every note (no index)
+    parse_notes_warm    loading and re-validating the index
+    parser_*            the parser alone: the header first and the content
+                        (links) read again on demand, or a single pass
+    generate_options    the fzf options of all the notes / of a common tag
+    fzf_reload          a tab in fzf (toggling a common tag), daemon state
+    fzf_preview         preview of a note / of a tag, cold and cached
+    view                assembling the view of a common tag
+
+fzf, bat and nvim are replaced by local stand-ins on PATH, so only knowit
+itself is measured. results are printed as json, to be compared across
+changes.
+
+    python bench/bench.py [--sizes 1000,10000] [--runs 5] [--corpus-dir DIR]
+                          [--output results.json]
+"""
+from os import path, environ, makedirs, chmod
+from io import BytesIO, StringIO
+import statistics
+import tempfile
+import argparse
+import platform
+import shutil
+import json
+import time
+import sys
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from corpus import Corpus
+from knowit import Knowit, build_parser
+from cache import PreviewCache
+from index import INDEX_DIR
+from note import Note, parse_record
+
+STUBS = {
+    "bat": "#!/bin/sh\nexec cat\n",
+    "nvim": "#!/bin/sh\nexit 0\n",
+    "fzf": "#!/bin/sh\nexec head -n 1\n",
+}
+
+
+def install_stubs(bin_dir):
+    makedirs(bin_dir, exist_ok=True)
+    for name, script in STUBS.items():
+        stub_path = path.join(bin_dir, name)
+        with open(stub_path, 'w') as f:
+            f.write(script)
+        chmod(stub_path, 0o755)
+    environ["PATH"] = f"{bin_dir}:{environ.get('PATH', '')}"
+
+
+def timed(func, runs, setup=None):
+    """seconds of each of runs calls of func (setup runs untimed before each)"""
+    times = []
+    for _ in range(runs):
+        if setup is not None: setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def result(name, size, times):
+    return {"name": name,
+            "notes": size,
+            "runs": len(times),
+            "min_ms": round(min(times) * 1000, 3),
+            "median_ms": round(statistics.median(times) * 1000, 3),
+            "max_ms": round(max(times) * 1000, 3)}
+
+
+def knowit(cwd, argv, tag_index=None, env=None, preview_cache=None):
+    args = build_parser().parse_args(["--cwd", cwd, "-j", "1"] + argv)
+    return Knowit(args,
+                  tag_index=tag_index,
+                  env=env if env is not None else {},
+                  out=BytesIO(),
+                  preview_cache=preview_cache if preview_cache is not None else PreviewCache())
+
+
+def bench_size(cwd, size, runs):
+    results = []
+    index_dir = path.join(cwd, INDEX_DIR)
+    drop_index = lambda: shutil.rmtree(index_dir, ignore_errors=True)
+
+    base = knowit(cwd, [])
+    times = timed(base.parse_notes, max(1, runs // 2), setup=drop_index)
+    results.append(result("parse_notes_cold", size, times))
+    times = timed(base.parse_notes, runs)
+    results.append(result("parse_notes_warm", size, times))
+
+    # the daemon keeps these between requests
+    state = knowit(cwd, [])
+    tag_index = state.tag_index
+    common = max(tag_index.counts, key=tag_index.counts.get)
+    notes = [note for note in tag_index.notes if note is not None]
+    note = notes[len(notes) // 2]
+
+    paths = [note.path for note in notes]
+    for name, parse in [("parser_two_pass", lambda p: Note.parse(p).record()),
+                        ("parser_single_pass", parse_record)]:
+        times = timed(lambda: [parse(p) for p in paths], runs)
+        results.append(dict(result(name, size, times),
+                            notes_per_s=round(len(paths) / statistics.median(times))))
+
+    times = timed(lambda: state._generate_options([]), runs)
+    results.append(result("generate_options_all", size, times))
+    times = timed(lambda: state._generate_options([common]), runs)
+    results.append(result("generate_options_tag", size, times))
+
+    env = {"FZF_QUERY": "", "FZF_BORDER_LABEL": ""}
+    reload = lambda: knowit(cwd, ["-t", f"#{common} [0]"], tag_index, env).fzf_reload()
+    results.append(result("fzf_reload", size, timed(reload, runs)))
+
+    cache = PreviewCache()
+    clear = lambda: cache.entries.clear()
+    note_option = f"{note.path} ({' '.join(f'#{tag}' for tag in note.tags)})"
+    for name, option in [("note", note_option), ("tag", f"#{common} [0]")]:
+        preview = lambda: knowit(cwd, ["--color", "-t", option], tag_index, env, cache).fzf_preview()
+        results.append(result(f"fzf_preview_{name}_cold", size, timed(preview, runs, setup=clear)))
+        results.append(result(f"fzf_preview_{name}_cached", size, timed(preview, runs)))
+
+    relevant = sorted(state.relevant_notes([common]), key=lambda x: x.epoch)
+    view = lambda: state.write_view(BytesIO(), StringIO(), [common], relevant)
+    results.append(result("view", size, timed(view, runs)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default="1000,10000", help="comma separated corpus sizes (notes)")
+    parser.add_argument('--runs', type=int, default=5, help="runs per measurement")
+    parser.add_argument('--tags', type=int, default=200, help="number of distinct tags")
+    parser.add_argument('--zipf', type=float, default=1.1, help="zipf exponent of the tag distribution")
+    parser.add_argument('--links', type=float, default=0.2, help="probability of a link per content line")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus-dir', help="keep (and reuse) the generated corpora there")
+    parser.add_argument('--output', help="write the json results to a file instead of stdout")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    tmp = tempfile.mkdtemp(prefix="knowit-bench-")
+    corpus_dir = args.corpus_dir or tmp
+    install_stubs(path.join(tmp, "bin"))
+
+    results = []
+    corpora = []
+    try:
+        for size in sizes:
+            corpus = Corpus(notes=size,
+                            tags=args.tags,
+                            zipf=args.zipf,
+                            links=args.links,
+                            seed=args.seed,
+                            shard=10000 if size > 100000 else 0)
+            cwd = path.join(corpus_dir, f"{size}-{args.tags}-{args.zipf}-{args.links}-{args.seed}")
+            if not path.isdir(cwd):
+                makedirs(cwd)
+                start = time.perf_counter()
+                corpus.generate(cwd)
+                corpora.append({"notes": size, "path": cwd,
+                                "generate_s": round(time.perf_counter() - start, 3)})
+            else:
+                corpora.append({"notes": size, "path": cwd})
+            results.extend(bench_size(cwd, size, args.runs))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {"python": platform.python_version(),
+              "platform": platform.platform(),
+              "config": {"tags": args.tags, "zipf": args.zipf, "links": args.links,
+                         "seed": args.seed, "runs": args.runs},
+              "corpora": corpora,
+              "results": results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
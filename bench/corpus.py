@@ -0,0 +1,108 @@
+"""
+synthetic note corpus generator, in the exact format Note.parse reads.
+
+    python bench/corpus.py <dir> --notes 10000 [--tags 500] [--zipf 1.1]
+                                 [--tags-per-note 1-4] [--links 0.2]
+                                 [--lines 1-40] [--seed 0] [--shard 0]
+
+tags are drawn from a zipfian distribution (a few very common tags and a
+long tail), like real notes collections.
+"""
+from datetime import datetime, timedelta
+from itertools import accumulate
+from os import makedirs, path
+import argparse
+import random
+
+WORDS = ("the of and to in is for on that with as by this at from it an be "
+         "are or was not but have all can if will one about up out time "
+         "server db cache deploy incident query index latency memory disk "
+         "config error retry timeout request log trace build release").split()
+
+
+def parse_range(value):
+    low, _, high = value.partition("-")
+    return int(low), int(high or low)
+
+
+class Corpus():
+    def __init__(self,
+                 notes=1000,
+                 tags=200,
+                 zipf=1.1,
+                 tags_per_note=(1, 4),
+                 links=0.2,
+                 lines=(1, 40),
+                 seed=0,
+                 shard=0):
+        self.count = notes
+        self.tags = [f"tag{i}" for i in range(tags)]
+        self.cum_weights = list(accumulate(1 / (rank ** zipf) for rank in range(1, tags + 1)))
+        self.tags_per_note = tags_per_note
+        self.links = links
+        self.lines = lines
+        self.seed = seed
+        self.shard = shard
+
+    def note_path(self, root, i):
+        if not self.shard: return path.join(root, f"{i}.md")
+        return path.join(root, f"{i // self.shard}", f"{i}.md")
+
+    def note(self, rnd, root, i, start):
+        timestamp = start + timedelta(minutes=i * 7 + rnd.randrange(7))
+        count = rnd.randint(*self.tags_per_note)
+        tags = set(rnd.choices(self.tags, cum_weights=self.cum_weights, k=count))
+
+        content = []
+        for _ in range(rnd.randint(*self.lines)):
+            line = " ".join(rnd.choices(WORDS, k=rnd.randint(3, 14)))
+            if i and rnd.random() < self.links:
+                target = self.note_path(root, rnd.randrange(i))
+                line += f" see [note]({target})"
+            content.append(line + "\n")
+
+        header = f"[{timestamp.strftime('%Y-%m-%d %H:%M:%S')}]"
+        header += "".join(f" #{tag}" for tag in sorted(tags))
+        return header + " \n\n---\n" + "".join(content)
+
+    def generate(self, root):
+        """write the corpus under root, return the paths of the notes"""
+        rnd = random.Random(self.seed)
+        start = datetime(2020, 1, 1)
+        paths = []
+        for i in range(self.count):
+            note_path = self.note_path(root, i)
+            if self.shard and i % self.shard == 0:
+                makedirs(path.dirname(note_path), exist_ok=True)
+            with open(note_path, 'w') as f:
+                f.write(self.note(rnd, root, i, start))
+            paths.append(note_path)
+        return paths
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', help="directory to write the notes to")
+    parser.add_argument('--notes', type=int, default=1000, help="number of notes")
+    parser.add_argument('--tags', type=int, default=200, help="number of distinct tags")
+    parser.add_argument('--zipf', type=float, default=1.1, help="zipf exponent of the tag distribution")
+    parser.add_argument('--tags-per-note', type=parse_range, default=(1, 4), help="min-max tags per note")
+    parser.add_argument('--links', type=float, default=0.2, help="probability of a link per content line")
+    parser.add_argument('--lines', type=parse_range, default=(1, 40), help="min-max content lines per note")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--shard', type=int, default=0, help="notes per sub directory (0: a single directory)")
+    args = parser.parse_args()
+
+    makedirs(args.root, exist_ok=True)
+    Corpus(notes=args.notes,
+           tags=args.tags,
+           zipf=args.zipf,
+           tags_per_note=args.tags_per_note,
+           links=args.links,
+           lines=args.lines,
+           seed=args.seed,
+           shard=args.shard).generate(args.root)
+
+
+if __name__ == "__main__":
+    main()
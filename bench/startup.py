@@ -0,0 +1,103 @@
+"""
+startup budget of the helper actions fzf runs on every preview/reload.
+
+runs each helper command line under `python -X importtime`, reports the total
+import time and fails (exit code 1) when a command goes over its budget or
+imports a module that should stay off the fast path.
+
+    python bench/startup.py [--runs 5] [--scale 1.0] [--json]
+"""
+from os import path
+import subprocess
+import tempfile
+import argparse
+import json
+import sys
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+# (name, script, budget in ms of import time)
+COMMANDS = [
+    ("client", "client.py", 40),
+    ("fzf_preview", "knowit.py", 60),
+    ("fzf_reload", "knowit.py", 60),
+]
+
+# modules only some actions need, never to be imported by the helpers
+FORBIDDEN = [
+    "requests",
+    "tempfile",
+    "traceback",
+    "concurrent.futures",
+    "socketserver",
+]
+
+
+def importtime(argv, env):
+    """return {module: (cumulative us, is top level)} for the imports of argv"""
+    p = subprocess.run([sys.executable, "-X", "importtime"] + argv,
+                       cwd=ROOT,
+                       stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE,
+                       env=env)
+    modules = {}
+    for line in p.stderr.decode().splitlines():
+        if not line.startswith("import time:"): continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit(): continue
+        name = fields[2].rstrip()
+        modules[name.strip()] = (int(fields[1]), not name.startswith("  "))
+    return modules
+
+
+def measure(name, script, cwd, runs):
+    if script == "client.py":
+        # without a daemon the client would start one and exec knowit.py,
+        # so only its own import path is measured
+        argv = ["-c", "import client"]
+    else:
+        argv = [path.join(ROOT, script), "--cwd", cwd, "-a", name, "-t", "#knowit"]
+    env = {"PATH": "", "FZF_QUERY": "", "FZF_BORDER_LABEL": ""}
+
+    totals = []
+    modules = {}
+    for _ in range(runs):
+        modules = importtime(argv, env)
+        totals.append(sum(us for us, top in modules.values() if top))
+    return min(totals) / 1000, modules
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help="take the best of that many runs")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiply the budgets (slow machines)")
+    parser.add_argument('--json', action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    results = []
+    failed = False
+    with tempfile.TemporaryDirectory() as cwd:
+        for name, script, budget in COMMANDS:
+            total, modules = measure(name, script, cwd, args.runs)
+            forbidden = [m for m in FORBIDDEN if m in modules]
+            ok = total <= budget * args.scale and not forbidden
+            failed |= not ok
+            results.append({"name": name,
+                            "import_ms": round(total, 2),
+                            "budget_ms": budget * args.scale,
+                            "forbidden": forbidden,
+                            "ok": ok})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            status = "ok" if r['ok'] else "FAIL"
+            print(f"{r['name']:<12} {r['import_ms']:>8.2f}ms / {r['budget_ms']:.0f}ms {status}"
+                  + (f" (imports {', '.join(r['forbidden'])})" if r['forbidden'] else ""))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+from os import makedirs, listdir, remove, replace, utime, getpid, path
+from collections import OrderedDict
+from hashlib import sha1
+
+from index import INDEX_DIR
+
+PREVIEW_DIR = "previews"
+MAX_PREVIEWS = 256
+
+
+class PreviewCache():
+    """
+    bounded LRU of rendered (colorized) previews.
+
+    kept in memory by the daemon, and on disk under the notes dir otherwise.
+    the key covers the stat of every note that contributed to the preview,
+    so a changed note can never be served from the cache.
+    """
+    def __init__(self, cwd=None, max_entries=MAX_PREVIEWS):
+        self.max_entries = max_entries
+        self.directory = path.join(cwd, INDEX_DIR, PREVIEW_DIR) if cwd else None
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def key(color, selection, notes):
+        """
+        color - whether the preview is syntax highlighted.
+        selection - what the preview is of (tags, or a note path).
+        notes - (path, stat) of the notes rendered in the preview.
+        """
+        h = sha1(f"{bool(color)}\0{selection!r}\0".encode())
+        for note_path, stat in notes:
+            h.update(f"{note_path}\0{stat!r}\0".encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        if self.directory is None:
+            if key not in self.entries: return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        entry_path = path.join(self.directory, key)
+        try:
+            with open(entry_path, 'rb') as f:
+                content = f.read()
+            utime(entry_path) # recently used
+            return content
+        except OSError:
+            return None
+
+    def put(self, key, content):
+        if self.directory is None:
+            self.entries[key] = content
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return
+
+        try:
+            makedirs(self.directory, exist_ok=True)
+            entry_path = path.join(self.directory, key)
+            tmp_path = f"{entry_path}.{getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            replace(tmp_path, entry_path)
+            self.evict()
+        except OSError:
+            pass
+
+    def evict(self):
+        names = listdir(self.directory)
+        if len(names) <= self.max_entries: return
+        entries = []
+        for name in names:
+            try:
+                entries.append((path.getmtime(path.join(self.directory, name)), name))
+            except OSError:
+                continue
+        entries.sort()
+        for _, name in entries[:len(entries) - self.max_entries]:
+            try:
+                remove(path.join(self.directory, name))
+            except OSError:
+                continue
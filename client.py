@@ -0,0 +1,106 @@
+"""
+minimal client for the knowit daemon (see server.py).
+
+fzf runs this once per preview/reload, so it only imports what it needs to
+forward its arguments and fzf environment to the daemon and print the reply.
+if no daemon is listening it starts one and falls back to running knowit.py
+directly for this call.
+"""
+from os import environ, getuid, path, execv, mkdir, lstat
+from stat import S_ISDIR
+from hashlib import sha1
+import socket
+import json
+import sys
+
+import tracing
+from tracing import span
+
+KNOWIT = path.join(path.dirname(path.abspath(__file__)), "knowit.py")
+
+
+def runtime_dir():
+    """
+    the directory of the daemon sockets and locks, only we can get in:
+    $XDG_RUNTIME_DIR/knowit, or /tmp/knowit-<uid>. raises OSError if it
+    isn't ours alone (someone else made it first).
+    """
+    base = environ.get("XDG_RUNTIME_DIR")
+    directory = path.join(base, "knowit") if base and path.isdir(base) else f"/tmp/knowit-{getuid()}"
+    try:
+        mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    st = lstat(directory)
+    if not S_ISDIR(st.st_mode) or st.st_uid != getuid() or st.st_mode & 0o077:
+        raise PermissionError(f"{directory} is not a private directory")
+    return directory
+
+
+def socket_path(cwd):
+    digest = sha1(path.abspath(cwd).encode()).hexdigest()[:12]
+    return path.join(runtime_dir(), f"{digest}.sock")
+
+
+def spawn_server(cwd):
+    """start a detached daemon for cwd, it exits by itself if one is running"""
+    from subprocess import Popen, DEVNULL
+    Popen([sys.executable, KNOWIT, "--cwd", cwd, "-a", "serve"],
+          stdin=DEVNULL,
+          stdout=DEVNULL,
+          stderr=DEVNULL,
+          start_new_session=True)
+
+
+def get_option(argv, names, default=None):
+    for i, arg in enumerate(argv[:-1]):
+        if arg in names: return argv[i + 1]
+    return default
+
+
+def get_cwd(argv):
+    return get_option(argv, ("--cwd",), path.expanduser("~/notes"))
+
+
+def connect(cwd, argv):
+    """send the request, return the socket to read the reply from"""
+    env = {k: v for k, v in environ.items() if k.startswith(("FZF_", "KNOWIT_"))}
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path(cwd))
+        s.sendall(json.dumps({"argv": argv, "env": env}).encode() + b"\n")
+        s.shutdown(socket.SHUT_WR)
+    except OSError:
+        s.close()
+        raise
+    return s
+
+
+def main():
+    argv = sys.argv[1:]
+    cwd = get_cwd(argv)
+    tracing.context['action'] = get_option(argv, ("-a", "--action"))
+    out = sys.stdout.buffer
+    with span("client"):
+        try:
+            s = connect(cwd, argv)
+        except OSError:
+            spawn_server(cwd)
+            execv(sys.executable, [sys.executable, KNOWIT] + argv)
+
+        # the reply is copied as it arrives, fzf shows the first of a preview
+        # while the daemon is still rendering the rest
+        try:
+            while True:
+                chunk = s.recv(65536)
+                if not chunk: break
+                out.write(chunk)
+                out.flush()
+        except BrokenPipeError:
+            pass # fzf doesn't need this preview anymore
+        finally:
+            s.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+from os import environ
+from collections import OrderedDict
+import socket
+
+from tracing import span
+
+# environment variable holding the --listen endpoint of the running fzf
+LISTEN_ENV = "KNOWIT_FZF_LISTEN"
+
+# clients of the last fzf sessions (the daemon outlives many), the least
+# recently used is closed past that many
+MAX_CLIENTS = 8
+_clients = OrderedDict()
+
+
+def allocate_endpoint():
+    """a free localhost port for fzf --listen, one per browse session"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(("127.0.0.1", 0))
+        return str(s.getsockname()[1])
+    finally:
+        s.close()
+
+
+def get_client(env=environ):
+    """client of the fzf serving env, None when not running under fzf --listen"""
+    endpoint = env.get(LISTEN_ENV) or env.get("FZF_PORT")
+    if not endpoint: return None
+    # a port may be reused by a later session, with another key
+    key = (endpoint, env.get("FZF_API_KEY"))
+    if key not in _clients:
+        _clients[key] = FzfClient(endpoint, api_key=key[1])
+        while len(_clients) > MAX_CLIENTS:
+            _, client = _clients.popitem(last=False)
+            client.close()
+    _clients.move_to_end(key)
+    return _clients[key]
+
+
+class FzfClient():
+    """
+    sends actions to fzf started with --listen, as a bare http POST over a
+    raw socket. the endpoint is either a port on localhost or a unix socket
+    path. the connection is reused for as long as fzf keeps it open.
+    """
+    def __init__(self, endpoint, api_key=None):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.sock = None
+
+    def connect(self):
+        if "/" in self.endpoint:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.endpoint)
+        else:
+            sock = socket.create_connection(("127.0.0.1", int(self.endpoint)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def close(self):
+        if self.sock is not None: self.sock.close()
+        self.sock = None
+
+    def send(self, *actions):
+        """
+        send the actions in a single request (chained with '+').
+        raises OSError if fzf can't be reached.
+        """
+        body = "+".join(actions).encode()
+        request = b"POST / HTTP/1.1\r\n"
+        request += b"Host: localhost\r\n"
+        if self.api_key: request += f"x-api-key: {self.api_key}\r\n".encode()
+        request += f"Content-Length: {len(body)}\r\n\r\n".encode()
+        request += body
+
+        with span("http", reused=self.sock is not None):
+            return self.post(request)
+
+    def post(self, request):
+        reused = self.sock is not None
+        try:
+            if self.sock is None: self.sock = self.connect()
+            self.sock.sendall(request)
+            return self.read_response()
+        except OSError:
+            self.close()
+            if not reused: raise
+            # fzf closed the connection we kept, retry once on a new one
+            self.sock = self.connect()
+            self.sock.sendall(request)
+            return self.read_response()
+
+    def read_response(self):
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = self.sock.recv(4096)
+            if not chunk: raise ConnectionError("fzf closed the connection")
+            data += chunk
+        head, body = data.split(b"\r\n\r\n", 1)
+        lines = head.decode('latin-1').split("\r\n")
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length", 0))
+        while len(body) < length:
+            chunk = self.sock.recv(4096)
+            if not chunk: break
+            body += chunk
+
+        if headers.get("connection", "").lower() == "close" or "content-length" not in headers:
+            self.close()
+        return status, body[:length]
@@ -0,0 +1,241 @@
+from os import scandir, makedirs, replace, getpid, path, cpu_count, stat, sep
+from stat import S_ISDIR
+import json
+
+from note import Note, ParseError, parse_record
+from pack import MemberStat, is_pack, at_root, open_pack, packed, packs
+from tracing import span
+
+INDEX_DIR = ".knowit"
+INDEX_FILE = "index.json"
+INDEX_VERSION = 5
+
+# below this many files to parse, a worker pool costs more than it saves
+PARALLEL_THRESHOLD = 256
+
+
+class NoteIndex():
+    """
+    persistent index of the parsed notes under a root directory.
+
+    every entry is keyed by the note path and holds the (mtime, size, inode)
+    of the file when it was parsed and its Note, so revalidating the index
+    only needs a stat per file - and only new or changed files are parsed
+    again. files that failed to parse are kept as well (with no note), so
+    they are not re-parsed on every run either - and why they failed is kept
+    in errors (path -> (line, reason)), see `knowit.py -a lint`.
+    the notes are only turned into records (Note.record()) for the index
+    file, in memory there's a single Note per file.
+
+    when many files need parsing (cold start) they are parsed by a pool of
+    `jobs` workers - threads when the filesystem is the bottleneck (network
+    mounts), processes when parsing is.
+
+    the packs (pack.py) right in the root are walked as the notes in them, a
+    packed note is re-validated against the size and mtime kept in its pack.
+    """
+    def __init__(self, root, jobs=None, executor="thread"):
+        self.root = root
+        self.jobs = jobs if jobs is not None else (cpu_count() or 1)
+        self.executor = executor
+        self.path = path.join(root, INDEX_DIR, INDEX_FILE)
+        self.entries = {}
+        self.errors = {}
+        self.dirty = False
+
+    def load(self):
+        try:
+            with span("load"), open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != INDEX_VERSION: return
+        for file_path, entry in data.get('entries', {}).items():
+            file_stat = tuple(entry['stat'])
+            record = entry['note']
+            note = Note.from_record(file_path, record, file_stat) if record is not None else None
+            self.entries[file_path] = (file_stat, note)
+            if entry.get('error') is not None: self.errors[file_path] = tuple(entry['error'])
+
+    def save(self):
+        if not self.dirty: return
+        try:
+            makedirs(path.dirname(self.path), exist_ok=True)
+            # a temporary file per process, the daemon, watch and fallback
+            # runs may save at the same time
+            tmp_path = f"{self.path}.{getpid()}.tmp"
+            entries = {}
+            for file_path, (file_stat, note) in self.entries.items():
+                entries[file_path] = {'stat': file_stat, 'note': note.record() if note is not None else None}
+                if file_path in self.errors: entries[file_path]['error'] = self.errors[file_path]
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': INDEX_VERSION, 'entries': entries}, f)
+            replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError:
+            # read-only notes directory, we will just re-validate next time
+            pass
+
+    def scan(self, top=None):
+        """
+        yield (path, stat) of every file under top (the root), skipping our
+        own dir - and of every note in the packs there.
+        """
+        dirs = [top or self.root]
+        while dirs:
+            current = dirs.pop()
+            try:
+                it = scandir(current)
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name != INDEX_DIR: dirs.append(entry.path)
+                        elif entry.is_file():
+                            if is_pack(entry.name):
+                                # only the packs right in the root are used
+                                if at_root(entry.path, self.root):
+                                    yield from self.members(entry.path, entry.stat())
+                            else:
+                                yield entry.path, entry.stat()
+                    except OSError:
+                        continue
+
+    @staticmethod
+    def members(pack_path, st=None):
+        """(path, stat) of the notes in the pack at pack_path"""
+        pack = open_pack(pack_path, st)
+        if pack is None: return []
+        return [(member, pack.member_stat(member)) for member in pack.members]
+
+    def refresh(self):
+        """
+        re-validate the index against the filesystem.
+        return the list of paths that were (re)parsed and the list of paths
+        that were removed.
+        """
+        files = {}
+        with span("walk") as s:
+            for file_path, st in self.scan():
+                # a file shadows the packed note of the same path
+                if isinstance(st, MemberStat) and file_path in files: continue
+                files[file_path] = st
+            s.set(files=len(files))
+        changed = self.revalidate(files.items())
+
+        removed = [p for p in self.entries if p not in files]
+        for p in removed: self.remove(p)
+
+        if changed or removed: self.dirty = True
+        return changed, removed
+
+    def update(self, paths):
+        """
+        like refresh(), but only for the given paths (files or directories),
+        as reported by a watcher (watch.py).
+        """
+        files = []
+        removed = []
+        index_dir = path.join(self.root, INDEX_DIR)
+        # packs first, a note moved into a pack is not removed
+        for p in sorted(paths, key=lambda p: (not is_pack(p), p)):
+            if p == index_dir or p.startswith(index_dir + sep): continue
+            if is_pack(p):
+                if not at_root(p, self.root): continue
+                old = packs[p].members if p in packs else {}
+                new = dict(self.members(p))
+                gone = [e for e in old if e not in new and e in self.entries and not path.exists(e)]
+                for e in gone: self.remove(e)
+                removed.extend(gone)
+                files.extend((e, st) for e, st in new.items() if not path.exists(e))
+                continue
+            try:
+                st = stat(p)
+            except OSError:
+                st = None
+            if st is None and packed(p) is not None:
+                # the file shadowing a packed note is gone
+                files.append((p, packed(p).member_stat(p)))
+                continue
+            if st is not None and not S_ISDIR(st.st_mode):
+                files.append((p, st))
+                continue
+
+            # deleted file or directory, or a directory moved in
+            prefix = p.rstrip(sep) + sep
+            gone = [e for e in self.entries if e == p or e.startswith(prefix)]
+            if st is not None:
+                existing = dict(self.scan(p))
+                files.extend(existing.items())
+                gone = [e for e in gone if e not in existing]
+            for e in gone: self.remove(e)
+            removed.extend(gone)
+
+        changed = self.revalidate(files)
+        if changed or removed: self.dirty = True
+        return changed, removed
+
+    def remove(self, file_path):
+        del self.entries[file_path]
+        self.errors.pop(file_path, None)
+
+    def revalidate(self, files):
+        """parse the (path, stat) files that are new or changed, return their paths"""
+        changed = {}
+        for file_path, st in files:
+            file_stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+            entry = self.entries.get(file_path)
+            if entry is not None and entry[0] == file_stat: continue
+            changed[file_path] = file_stat
+
+        # merge in path order, whichever worker finished first
+        changed = sorted(changed.items())
+        with span("parse", files=len(changed)) as s:
+            # packed notes are read from the mapped pack, no worker needed
+            loose = [file_path for file_path, _ in changed if packed(file_path) is None or path.exists(file_path)]
+            results = dict(zip(loose, self.parse_all(loose)))
+            results = [results[file_path] if file_path in results else NoteIndex.parse(file_path)
+                       for file_path, _ in changed]
+            s.set(errors=sum(error is not None for _, error in results))
+        for (file_path, file_stat), (record, error) in zip(changed, results):
+            note = Note.from_record(file_path, record, file_stat) if record is not None else None
+            self.entries[file_path] = (file_stat, note)
+            if error is not None:
+                self.errors[file_path] = error
+            else:
+                self.errors.pop(file_path, None)
+        return [file_path for file_path, _ in changed]
+
+    def parse_all(self, paths):
+        if self.jobs <= 1 or len(paths) < PARALLEL_THRESHOLD:
+            return [NoteIndex.parse(file_path) for file_path in paths]
+
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        Executor = ProcessPoolExecutor if self.executor == "process" else ThreadPoolExecutor
+        with Executor(max_workers=self.jobs) as pool:
+            chunksize = max(1, len(paths) // (self.jobs * 4))
+            return list(pool.map(NoteIndex.parse, paths, chunksize=chunksize))
+
+    @staticmethod
+    def parse(file_path):
+        """
+        (record, None) of the note at file_path, or (None, (line, reason))
+        when it is not a note - cheap to send back from a worker process.
+        """
+        try:
+            return parse_record(file_path), None
+        except ParseError as e:
+            return None, (e.line, e.reason)
+        except Exception as e:
+            return None, (None, str(e))
+
+    def note(self, file_path):
+        """the Note of file_path, None if it is not (a valid) note"""
+        entry = self.entries.get(file_path)
+        if entry is None: return None
+        return entry[1]
+
+    def notes(self):
+        return [note for _, note in self.entries.values() if note is not None]
@@ -1,15 +1,31 @@
-from os import walk, path, environ, remove, isatty, ctermid
+from os import path, environ, isatty, ctermid, stat
 from subprocess import Popen, PIPE, DEVNULL
 from sys import stdin, stdout, stderr
-from datetime import datetime
-from requests import post
-from time import sleep
-import traceback
+from datetime import datetime, timedelta
 import argparse
-import tempfile
 import re
 
-from note import Note
+from note import Note, to_epoch
+from pack import open_note, note_stat, exists, extract, packed, set_roots
+from roots import Roots, parse_roots, primary_root
+from tag_index import TagIndex
+import tag_query
+from cache import PreviewCache
+from store import NoteStore, write_atomic
+import view as view_file
+import tracing
+from tracing import span
+
+# fzf runs this script once per preview/reload when the daemon is not up, keep
+# imports that only some actions need (tempfile, traceback, fzf, ...)
+# inside those actions. bench/startup.py checks this stays the case.
+
+CLIENT = path.join(path.dirname(path.abspath(__file__)), "client.py")
+PACK = path.join(path.dirname(path.abspath(__file__)), "pack.py")
+
+# budget of the preview of a tag selection (see preview_chunks())
+PREVIEW_LINES = 1000
+PREVIEW_BYTES = 256 * 1024
 
 def log(message):
     with open('/tmp/knowit.log', 'a+') as f:
@@ -32,15 +48,17 @@ def vim(path, commands=[]):
         if "FZF_DEFAULT_OPTS" in environ: del environ["FZF_DEFAULT_OPTS"]
         if "FZF_QUERY" in environ: del environ["FZF_QUERY"] # unset fzf context detection
 
-        p = Popen(cmd,
-                  stdin=_stdin,
-                  stdout=_stdout,
-                  stderr=_stdout,
-                  env=environ)
+        with span("subprocess", command="nvim"):
+            p = Popen(cmd,
+                      stdin=_stdin,
+                      stdout=_stdout,
+                      stderr=_stdout,
+                      env=environ)
 
-        output, errors = p.communicate()
+            output, errors = p.communicate()
         return p.returncode
     except Exception as e:
+        import traceback
         open('/tmp/knowit.log', 'a+').write(f"traceback: {traceback.format_exc()}")
         # print(f"traceback: {traceback.format_exc()}")
 
@@ -50,6 +68,58 @@ def bat(content):
     """
     try:
         env = environ.copy()
+        with span("subprocess", command="bat", bytes=len(content)):
+            p = Popen(["bat",
+                       "-l", "md", # markdown language
+                       "--style=auto",
+                       "--color=always",
+                       ],
+                      stdin=PIPE,
+                      stdout=PIPE,
+                      stderr=stderr,
+                      env=env)
+            # bat streams, writing all of a big preview before reading any of
+            # the output would deadlock on the pipes - communicate() does both
+            output, errors = p.communicate(content.encode())
+        return output
+
+    except Exception as e:
+        import traceback
+        print(f"traceback: {traceback.format_exc()}")
+
+def current_stat(note_path):
+    """(mtime, size, inode) of the note as it is now, None if it is gone"""
+    try:
+        st = note_stat(note_path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def stream(chunks, out, color):
+    """
+    write the chunks (strings) to out as they come - through bat when color -
+    flushing as it goes, so fzf shows the first of a preview before the rest
+    is rendered. return all that was written, for the preview cache.
+    """
+    written = []
+    broken = []
+    def write(data):
+        written.append(data)
+        if broken: return
+        try:
+            out.write(data)
+            out.flush()
+        except OSError:
+            # fzf moved on to another preview, keep draining bat
+            broken.append(True)
+
+    if not color:
+        for chunk in chunks: write(chunk.encode())
+        return b"".join(written)
+
+    from threading import Thread
+    with span("subprocess", command="bat"):
         p = Popen(["bat",
                    "-l", "md", # markdown language
                    "--style=auto",
@@ -58,18 +128,45 @@ def bat(content):
                   stdin=PIPE,
                   stdout=PIPE,
                   stderr=stderr,
-                  env=env)
-        # write the options to stdin before launching the pocess with communicate()
-        p.stdin.write(content.encode())
-        output, errors = p.communicate()
-        return output
-
-    except Exception as e: print(f"traceback: {traceback.format_exc()}")
+                  env=environ.copy())
+        # bat's output is copied while we still write to it, so neither side
+        # blocks on a full pipe
+        reader = Thread(target=lambda: [write(data) for data in iter(lambda: p.stdout.read1(64 * 1024), b"")])
+        reader.start()
+        try:
+            for chunk in chunks:
+                p.stdin.write(chunk.encode())
+                p.stdin.flush()
+        finally:
+            p.stdin.close()
+            reader.join()
+            p.wait()
+    return b"".join(written)
 
 class Knowit():
-    def __init__(self, args=None):
+    def __init__(self,
+                 args=None,
+                 tag_index=None,
+                 env=None,
+                 out=None,
+                 preview_cache=None,
+                 search_index=None,
+                 link_graph=None):
         self.args = args
-        self.notes = self.parse_notes()
+        # the daemon (server.py) passes its in-memory indexes and preview
+        # cache, and the fzf environment/output of the client it is serving.
+        self.env = env if env is not None else environ
+        self.out = out if out is not None else stdout.buffer
+        # notes are created (and views and caches kept) in the first root
+        self.root = primary_root(self.args.cwd)
+        set_roots(parse_roots(self.args.cwd))
+        self.note_index = None
+        self._search_index = search_index
+        self._link_graph = link_graph
+        self.tag_index = tag_index if tag_index is not None else TagIndex(self.parse_notes())
+        self.notes = self.tag_index.notes
+        tracing.context['notes'] = len(self.tag_index)
+        self.preview_cache = preview_cache if preview_cache is not None else PreviewCache(self.root)
 
         new_tags = []
         # remove the '#' if exists
@@ -81,65 +178,91 @@ class Knowit():
         self.args.tags = new_tags
 
     def parse_notes(self):
-        notes = []
-        for root, dir, files in walk(self.args.cwd):
-            for f in files:
-                file_path = path.join(root, f)
-                try:
-                    note = Note.parse(file_path)
-                    notes.append(note)
-                except Exception as e:
-                    # print(f"[!] failed to parse note: {e}")
-                    continue
-        return notes
+        # only new/changed files are parsed, the rest comes from the index of
+        # every root
+        roots = Roots(self.args.cwd, jobs=self.args.jobs, executor=self.args.parse_executor)
+        roots.refresh()
+        self.note_index = roots
+        return roots.notes()
+
+    @property
+    def search_index(self):
+        if self._search_index is None:
+            from search import SearchIndex
+            self._search_index = SearchIndex(self.root)
+            self._search_index.load()
+            self._search_index.refresh(self.note_index.entries)
+            self._search_index.save()
+        return self._search_index
 
     def get_tags(self):
-        all_tags = {}
+        return dict(self.tag_index.counts)
+
+    def match(self, tags):
+        """ids of the notes matching the tag query of tags, within --since/--until/--last, oldest first"""
+        return self.tag_index.match(tag_query.parse(tags), self.args.since, self.args.until, self.args.last)
+
+    def filtered(self):
+        return self.args.since is not None or self.args.until is not None or self.args.last is not None
+
+    def filter_options(self):
+        """the --since/--until/--last and preview budget options, for the commands fzf runs"""
+        options = ""
+        if self.args.since is not None: options += f" --since @{self.args.since}"
+        if self.args.until is not None: options += f" --until @{self.args.until}"
+        if self.args.last is not None: options += f" --last {self.args.last}"
+        if self.args.preview_lines != PREVIEW_LINES: options += f" --preview-lines {self.args.preview_lines}"
+        if self.args.preview_bytes != PREVIEW_BYTES: options += f" --preview-bytes {self.args.preview_bytes}"
+        return options
 
-        for note in self.notes:
-            for tag in note.tags:
-                if tag not in all_tags: all_tags[tag] = 0
-                all_tags[tag] += 1
-        return all_tags
+    def relevant_notes(self, tags):
+        """notes matching the tag query of tags, oldest first"""
+        with span("filter") as s:
+            notes = [self.notes[i] for i in self.match(tags)]
+            s.set(matched=len(notes))
+        return notes
+
+    @property
+    def link_graph(self):
+        if self._link_graph is None:
+            from links import LinkGraph
+            self._link_graph = LinkGraph(self.notes)
+        return self._link_graph
 
     def get_links(self):
-        all_links = []
+        """every link target of the notes, as absolute paths - broken ones too (see LinkGraph.resolved())"""
+        return list(self.link_graph.backward)
 
-        for note in self.notes:
-            for link in note.links:
-                # link_from = link[0]
-                link_id = link[1]
-                # link_to = link[2]
-                all_links.append(link_id)
-        all_links = list(set(all_links))
-        return all_links
+    def linked_files(self, notes):
+        """the existing files the notes link to"""
+        files = []
+        for note in notes:
+            files.extend(self.link_graph.links(note.path))
+        return list(dict.fromkeys(files))
 
     def create(self):
-        i = 0
         selected = self.args.tags
         fzf_selected = ""
-        fzf_query = environ.get('FZF_QUERY', "")
-        fzf_label = environ.get('FZF_BORDER_LABEL', "")
+        fzf_query = self.env.get('FZF_QUERY', "")
+        fzf_label = self.env.get('FZF_BORDER_LABEL', "")
 
         # in case we in fzf context, initialize accordingly
-        if "FZF_QUERY" in environ:
+        if "FZF_QUERY" in self.env:
             assert len(selected) == 1
             fzf_selected, note_path = self.fzf_selected_parse(selected[0])
             selected = []
 
         if fzf_label:
-            selected = ''.join(fzf_label.split()) # remove all spaces
-            selected = selected.strip().split("#")
-            selected = [x for x in selected if x] # remove empty strings
+            selected = tag_query.terms(fzf_label)
             fzf_selected = selected
 
         if fzf_query:
             selected.extend(fzf_selected)
 
-        tags = list(set(selected))
+        # the note gets the tags the query requires
+        tags = [tag for tag in dict.fromkeys(selected) if tag_query.is_tag(tag)]
 
-        while path.exists(path.join(self.args.cwd, f"{i}.md")): i += 1
-        note_path = path.join(self.args.cwd, f"{i}.md")
+        note_path = NoteStore(self.root).allocate()[0]
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         content = f"[{timestamp}]{''.join([' #'+tag for tag in tags])}\n\n"
         content += "---" + "\n"
@@ -150,11 +273,11 @@ class Knowit():
         """open view of relevant tags in vim"""
         tags = self.args.tags
         fzf_selected = ""
-        fzf_query = environ.get('FZF_QUERY', "")
-        fzf_label = environ.get('FZF_BORDER_LABEL', "")
+        fzf_query = self.env.get('FZF_QUERY', "")
+        fzf_label = self.env.get('FZF_BORDER_LABEL', "")
 
         # in case we in fzf context, initialize accordingly
-        if "FZF_QUERY" in environ:
+        if "FZF_QUERY" in self.env:
             assert len(tags) == 1
             fzf_selected, note_path = self.fzf_selected_parse(tags[0])
             if note_path:
@@ -163,9 +286,7 @@ class Knowit():
             tags = []
 
         if fzf_label:
-            tags = ''.join(fzf_label.split()) # remove all spaces
-            tags = tags.strip().split("#")
-            tags = [x for x in tags if x] # remove empty strings
+            tags = tag_query.terms(fzf_label)
 
         if fzf_query:
             tags.extend(fzf_selected)
@@ -173,90 +294,101 @@ class Knowit():
             tags.extend(fzf_selected)
 
         tags = list(set(tags))
-        lines = []
-        map = {}
-
-        prev_existed = False
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        lines.append(f"[{timestamp}]{''.join([' #'+tag for tag in tags])}\n")
-
-        relevant_notes = []
-        for note in self.notes:
-            if not set(tags).issubset(set(note.tags)): continue
-            relevant_notes.append(note)
 
-        # order notes by time of creation
-        relevant_notes.sort(key=lambda x:x.timestamp)
+        # ordered by time of creation
+        relevant_notes = self.relevant_notes(tags)
 
         # if one note, open directly.
         if len(relevant_notes) == 1:
+            extract(relevant_notes[0].path)
             vim(relevant_notes[0].path)
             return
 
-        for note in relevant_notes:
-            lines.extend(["\n", "---\n"])
+        file_path = NoteStore(self.root).allocate()[0]
 
-            map[note.path] = [len(lines) + 1]
+        import tempfile
+        with tempfile.NamedTemporaryFile(suffix=".md") as fp, \
+             tempfile.NamedTemporaryFile('w', suffix=".vim") as vim_script:
+            vim_script.write("set nopaste\n") # undo the set paste done at the begining
+            vim_script.write("set foldmethod=manual\n")
+            vim_script.write("normal! zE\n") # remove all folds
 
-            # first line of note (for folding next)
-            note_content = open(note.path).readlines()
-            lines.extend([
-                            f"{note.path}\n",
-                            "\n",
-                            "---\n",
-                          ])
-            lines.extend(note_content.copy())
-            # last line of note (for folding next)
-            map[note.path].append(len(lines))
-            prev_existed = True
-
-        i = 0
-        while path.exists(path.join(self.args.cwd, f"{i}.md")): i += 1
-        file_path = path.join(self.args.cwd, f"{i}.md")
-
-        vim_script = f"set nopaste\n" # undo the set paste done at the begining
-        vim_script += "set foldmethod=manual\n\n"
-        vim_script += f"execute \"normal! zE\"\n" # remove all folds
-        for note_path in map:
-            start = map[note_path][0]
-            end = map[note_path][1]
-            # configure folds per note
-            vim_script += f"execute \"normal! :{start},{end}fold\\<cr>\"\n"
-
-        vim_script += f"execute \"normal! zR\"\n" # open folds
-        vim_script += f"execute \"normal! gg\"\n" # move cursor to begining
-
-        vim_script_path = "/tmp/knowit.vim"
-        open(vim_script_path, "w+").write("".join(vim_script))
-
-        with tempfile.NamedTemporaryFile() as fp:
-            fp.write(''.join(lines).encode())
+            with span("render", notes=len(relevant_notes)):
+                state = self.write_view(fp, vim_script, tags, relevant_notes)
+            view_file.save_state(self.root, file_path, state)
+
+            vim_script.write("normal! zR\n") # open folds
+            vim_script.write("normal! gg\n") # move cursor to begining
             fp.flush()
+            vim_script.flush()
 
             rc = vim(file_path, ["set paste",
                                  f"normal :read {fp.name} \rggdd",
-                                 f":source {vim_script_path}"])
-        remove(vim_script_path)
+                                 f":source {vim_script.name}"])
 
-    def _generate_options(self):
-        selected = self.args.tags
+    def write_view(self, out, vim_script, tags, notes):
+        """
+        stream the view of notes into out (binary), one block per note, and
+        a fold per note into vim_script. notes are copied file to file, so
+        memory use doesn't grow with the size of the view.
+        return the sync() state of the view (hash and stat per note).
+
+        notes are read as text, like sync() reads them (universal newlines),
+        so the hash is view_file.content_hash() of the lines sync() sees.
+        """
+        from hashlib import sha1
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        header = tag_query.label(tags)
+        out.write(f"[{timestamp}]{' ' + header if header else ''}\n".encode())
+        line = 1
+
+        state = {}
+        for note in notes:
+            out.write("".join(view_file.block_header(note.path)).encode())
+            # first line of note (for folding next), the path line
+            start = line + 3
+            line += 5
+
+            h = sha1()
+            with open_note(note.path, 'r') as f:
+                st = note_stat(note.path)
+                newline = True
+                while True:
+                    chunk = f.read(64 * 1024)
+                    if not chunk: break
+                    chunk = chunk.encode()
+                    out.write(chunk)
+                    h.update(chunk)
+                    line += chunk.count(b"\n")
+                    newline = chunk.endswith(b"\n")
+            if not newline:
+                # keep the next block header on its own line
+                out.write(b"\n")
+                h.update(b"\n")
+                line += 1
+            state[note.path] = {'hash': h.hexdigest(), 'stat': view_file.stat_key(st)}
+
+            # last line of note (for folding next)
+            vim_script.write(f"{start},{line}fold\n")
+        return state
+
+    def _generate_options(self, selected=None):
+        if selected is None: selected = self.args.tags
         options = []
-        tags_map = {}
-        relevant_notes = []
-        for note in self.notes:
-            if not set(selected).issubset(set(note.tags)): continue
-            relevant_notes.append(note)
-            for tag in note.tags:
-                if tag not in tags_map: tags_map[tag] = 0
-                tags_map[tag] += 1
+        with span("filter") as s:
+            ids = self.match(selected)
+            tags_map = self.tag_index.facets(ids)
+            s.set(matched=len(ids))
         # remove already selected tags
-        for tag in selected: del tags_map[tag]
-
-        if len(relevant_notes) > 1:
-            for tag, count in reversed(sorted(tags_map.items(), key=lambda x: x[1])):
-                options.append(f"#{tag} [{count}]")
-        for note in relevant_notes:
-            options.append(f"{note.path} ({' '.join([f'#{tag}' for tag in note.tags])})")
+        for tag in tag_query.tags(tag_query.parse(selected)): tags_map.pop(tag, None)
+
+        with span("render", options=len(ids) + len(tags_map)):
+            if len(ids) > 1:
+                for tag, count in reversed(sorted(tags_map.items(), key=lambda x: x[1])):
+                    options.append(f"#{tag} [{count}]")
+            for i in ids:
+                note = self.notes[i]
+                options.append(f"{note.path} ({' '.join([f'#{tag}' for tag in note.tags])})")
         return options
 
     def browse(self):
@@ -266,16 +398,16 @@ class Knowit():
 
         self.tag_fzf(   options,
                         selected=selected,
-                        on_enter=f"become(python {path.abspath(__file__)} --cwd {self.args.cwd} -a view -t {{}})")
+                        on_enter=f"become(python {path.abspath(__file__)} --cwd {self.args.cwd} -a view{self.filter_options()} -t {{}})")
 
     def link(self):
         tags = self.args.tags
         fzf_selected = ""
-        fzf_query = environ.get('FZF_QUERY', "")
-        fzf_label = environ.get('FZF_BORDER_LABEL', "")
+        fzf_query = self.env.get('FZF_QUERY', "")
+        fzf_label = self.env.get('FZF_BORDER_LABEL', "")
 
         # in case we in fzf context, initialize accordingly
-        if "FZF_QUERY" in environ:
+        if "FZF_QUERY" in self.env:
             assert len(tags) == 1
             fzf_selected, note_path = self.fzf_selected_parse(tags[0])
             if note_path:
@@ -286,17 +418,12 @@ class Knowit():
             tags = []
 
             if fzf_label:
-                tags = ''.join(fzf_label.split()) # remove all spaces
-                tags = tags.strip().split("#")
-                tags = [x for x in tags if x] # remove empty strings
+                tags = tag_query.terms(fzf_label)
 
             tags.extend(fzf_selected)
             tags = list(set(tags))
 
-            relevant_notes = []
-            for note in self.notes:
-                if not set(tags).issubset(set(note.tags)): continue
-                relevant_notes.append(note)
+            relevant_notes = self.relevant_notes(tags)
 
             # if one note, open directly.
             if len(relevant_notes) == 1:
@@ -307,7 +434,7 @@ class Knowit():
             return
 
         options = self._generate_options()
-        on_enter = f"become(python {path.abspath(__file__)} --cwd {self.args.cwd} -a link -t {{}})"
+        on_enter = f"become(python {path.abspath(__file__)} --cwd {self.args.cwd} -a link{self.filter_options()} -t {{}})"
         self.tag_fzf(options, selected=tags, on_enter=on_enter)
 
     def grep(self):
@@ -316,39 +443,43 @@ class Knowit():
         locations = []
         tags = self.args.tags
         fzf_selected = ""
-        fzf_query = environ.get('FZF_QUERY', "")
-        fzf_label = environ.get('FZF_BORDER_LABEL', "")
+        fzf_query = self.env.get('FZF_QUERY', "")
+        fzf_label = self.env.get('FZF_BORDER_LABEL', "")
 
         # in case we in fzf context, initialize accordingly
-        if "FZF_QUERY" in environ:
+        if "FZF_QUERY" in self.env:
             assert len(tags) == 1
             fzf_selected, note_path = self.fzf_selected_parse(tags[0])
             tags = []
 
         if fzf_label:
-            tags = ''.join(fzf_label.split()) # remove all spaces
-            tags = tags.strip().split("#")
-            tags = [x for x in tags if x] # remove empty strings
+            tags = tag_query.terms(fzf_label)
 
         if fzf_query:
             tags.extend(fzf_selected)
 
-        if not tags: locations.append(self.args.cwd) # search all
+        if not tags and not self.filtered():
+            locations.extend(parse_roots(self.args.cwd)) # search all
+            notes = self.note_index.entries if self.note_index is not None else []
         else:
-            for note in self.notes:
-                if not set(tags).issubset(set(note.tags)): continue
-                locations.append(note.path)
-                for link in note.links:
-                    link_path = link[1]
-                    if path.isfile(link_path):
-                        locations.append(link[1])
+            relevant_notes = self.relevant_notes(tags)
+            locations.extend(note.path for note in relevant_notes)
+            locations.extend(self.linked_files(relevant_notes))
+            notes = locations
+
+        # rg can't look into packs, packed notes are searched through the index
+        packed_notes = any(packed(p) is not None and not path.exists(p) for p in notes)
 
         locations = list(set(locations)) # remove duplicates
-        result = self.rg_fzf(locations)
+        if self.args.search_backend == "index" or packed_notes:
+            result = self.index_fzf(tags, packed_notes)
+        else:
+            result = self.rg_fzf(locations)
         if not result: return
 
         file_path = result.split(":")[0]
         file_line = result.split(":")[1]
+        extract(file_path)
         vim(file_path, [file_line])
 
     def tag(self):
@@ -366,16 +497,176 @@ class Knowit():
         - if new notes were added, add them to the notes
         - if new notes were added externally that fits the view (based
           on the tags of the view), append them to the end of the view.
+        - if notes were deleted externally, remove them from the view (a
+          conflict if they were changed in the view).
         """
         if not self.args.view_path:
             print("'view_sync' action need --view-path option to be set.")
             return
-        pass
+
+        view_path = self.args.view_path
+        lines = open(view_path).readlines()
+        tags, blocks = view_file.parse_view(lines)
+        state = view_file.load_state(self.root, view_path)
+
+        refreshed = False
+        for n, (note_path, content) in enumerate(blocks):
+            view_hash = view_file.content_hash(content)
+            base = state.get(note_path)
+
+            if not exists(note_path) and base is None:
+                # a note added inside the view
+                write_atomic(note_path, "".join(content))
+                state[note_path] = {'hash': view_hash, 'stat': view_file.stat_key(stat(note_path))}
+                print(f"created {note_path}")
+                continue
+
+            if not exists(note_path):
+                if view_hash != base['hash']:
+                    # deleted, but changed in the view
+                    print(f"conflict {note_path}")
+                    continue
+                # deleted outside of the view, it goes from the view as well
+                blocks[n] = None
+                del state[note_path]
+                refreshed = True
+                print(f"deleted {note_path}")
+                continue
+
+            # only read the source if it changed since it was put in the view
+            st = note_stat(note_path)
+            if base and base['stat'] == view_file.stat_key(st):
+                source = None
+                source_hash = base['hash']
+            else:
+                with open_note(note_path, 'r') as f: source = f.readlines()
+                source_hash = view_file.content_hash(source)
+
+            if view_hash == source_hash:
+                pass
+            elif base and source_hash == base['hash']:
+                # changed in the view only
+                extract(note_path)
+                write_atomic(note_path, "".join(content))
+                view_hash = view_file.content_hash(content)
+                print(f"updated {note_path}")
+            elif base and view_hash == base['hash']:
+                # changed in the note only, bring it into the view
+                blocks[n] = (note_path, view_file.terminated(source))
+                view_hash = source_hash
+                refreshed = True
+                print(f"refreshed {note_path}")
+            else:
+                print(f"conflict {note_path}")
+                continue
+            state[note_path] = {'hash': view_hash, 'stat': view_file.stat_key(note_stat(note_path))}
+
+        blocks = [block for block in blocks if block is not None]
+
+        # notes matching the view that are not in it yet
+        in_view = set(note_path for note_path, _ in blocks)
+        in_view.add(path.abspath(view_path))
+        added = []
+        for note in self.relevant_notes(tags):
+            if note.path in in_view or path.abspath(note.path) in in_view: continue
+            with open_note(note.path, 'r') as f:
+                content = f.readlines()
+            st = note_stat(note.path)
+            added.append((note.path, view_file.terminated(content)))
+            state[note.path] = {'hash': view_file.content_hash(content), 'stat': view_file.stat_key(st)}
+            print(f"appended {note.path}")
+
+        if refreshed:
+            new_lines = [lines[0]]
+            for note_path, content in blocks + added:
+                new_lines.extend(view_file.block_header(note_path))
+                new_lines.extend(content)
+            write_atomic(view_path, "".join(new_lines))
+        elif added:
+            with open(view_path, 'a') as f:
+                if lines and not lines[-1].endswith("\n"): f.write("\n")
+                for note_path, content in added:
+                    f.write("".join(view_file.block_header(note_path)))
+                    f.write("".join(content))
+
+        view_file.save_state(self.root, view_path, state)
+
+    def search(self):
+        """
+        answer a grep query (--query) from the search index, printing rg like
+        'path:line:column:text' lines. scoped to the notes of the tags (and
+        the files they link to) like grep() does.
+        """
+        paths = None
+        extra = []
+        if self.args.tags or self.filtered():
+            relevant_notes = self.relevant_notes(self.args.tags)
+            paths = set(note.path for note in relevant_notes)
+            extra = self.linked_files(relevant_notes)
+
+        for line in self.search_index.search(self.args.query or "", paths, extra):
+            self.out.write(f"{line}\n".encode())
+        self.out.flush()
+
+    def query(self):
+        """print the notes, tags, links or backlinks (--kind) of the tags as ndjson/tsv, for scripts"""
+        from query import Query, write
+        records = getattr(Query(self.tag_index, self._link_graph), self.args.kind)(self.args.tags,
+                                                                 since=self.args.since,
+                                                                 until=self.args.until,
+                                                                 last=self.args.last,
+                                                                 offset=self.args.offset,
+                                                                 limit=self.args.limit)
+        write(records, self.out, self.args.kind, self.args.format)
+
+    def lint(self):
+        """list the files that are not valid notes, and why"""
+        for index in self.note_index.indexes:
+            for file_path, (line, reason) in sorted(index.errors.items()):
+                print(f"{file_path}:{line}: {reason}" if line is not None else f"{file_path}: {reason}")
+
+    def pack(self):
+        """move the notes of the tags (files) into the pack of their root, see pack.py"""
+        from pack import PACK_FILE, pack_notes
+        by_root = {}
+        for note in self.relevant_notes(self.args.tags):
+            if not path.isfile(note.path): continue
+            index = self.note_index.index_of(note.path)
+            if index is not None: by_root.setdefault(index.root, []).append(note.path)
+
+        for root, paths in by_root.items():
+            pack_path = path.join(root, PACK_FILE)
+            print(f"packed {len(pack_notes(pack_path, paths))} notes into {pack_path}")
+
+    def unpack(self):
+        """move the packed notes of the tags back into files"""
+        from pack import unpack_notes
+        by_pack = {}
+        for note in self.relevant_notes(self.args.tags):
+            pack = packed(note.path)
+            if pack is not None: by_pack.setdefault(pack.path, []).append(note.path)
+
+        for pack_path, paths in by_pack.items():
+            print(f"unpacked {len(unpack_notes(pack_path, paths))} notes from {pack_path}")
+
+    def index_fzf(self, tags, packed_notes=False):
+        from shlex import quote
+        # terms of a tag query have spaces, parentheses and '#' in them
+        search_cmd = f"python {CLIENT} --cwd {quote(self.args.cwd)} -a search{self.filter_options()}"
+        if tags: search_cmd += f" -t {' '.join(quote(tag) for tag in tags)}"
+        # --query= so a query starting with '-' isn't taken as an option
+        return self.grep_fzf(lambda query: f"{search_cmd} --query={query}", packed_notes)
 
     def rg_fzf(self, locations):
         rg_prefix = "rg -H --column --line-number --no-heading --color=always --smart-case "
         rg_suffix = f" {' '.join(locations)}"
+        return self.grep_fzf(lambda query: f"{rg_prefix} {query} {rg_suffix}")
 
+    def grep_fzf(self, search_cmd, packed_notes=False):
+        """
+        search_cmd(query) - shell command printing the matches of query.
+        packed_notes - matches may be in packs, bat reads them through pack.py.
+        """
         initial_query = "\"\""
         cmd = ["fzf"]
         env = environ.copy()
@@ -383,23 +674,27 @@ class Knowit():
         fzf_options += "--delimiter : "
         fzf_options += "--disabled "
         fzf_options += f"--query {initial_query} "
-        fzf_options += f"--bind \"change:reload:{rg_prefix} {{q}} {rg_suffix} || true\" "
+        fzf_options += f"--bind \"change:reload:{search_cmd('{q}')} || true\" "
         fzf_options += "--bind 'ctrl-k:preview-up' "
         fzf_options += "--bind 'ctrl-j:preview-down' "
         fzf_options += "--bind 'ctrl-u:preview-half-page-up' "
         fzf_options += "--bind 'ctrl-d:preview-half-page-down' "
         fzf_options += "--preview-window 'down,80%,+{2}-/2' "
-        fzf_options += "--preview 'bat --style=auto --color=always -H {2} {1}' "
+        if packed_notes:
+            fzf_options += f"--preview 'python {PACK} {{1}} {self.args.cwd} | bat --style=auto --color=always -H {{2}} --file-name {{1}}' "
+        else:
+            fzf_options += "--preview 'bat --style=auto --color=always -H {2} {1}' "
 
-        env["FZF_DEFAULT_COMMAND"] = f"{rg_prefix} {initial_query} {rg_suffix}"
+        env["FZF_DEFAULT_COMMAND"] = search_cmd(initial_query)
         env["INITIAL_QUERY"] = initial_query
         env["FZF_DEFAULT_OPTS"] = fzf_options
-        p = Popen(cmd,
-                  stdin=stdin,
-                  stdout=PIPE,
-                  stderr=stderr,
-                  env=env)
-        output, errors = p.communicate()
+        with span("subprocess", command="fzf"):
+            p = Popen(cmd,
+                      stdin=stdin,
+                      stdout=PIPE,
+                      stderr=stderr,
+                      env=env)
+            output, errors = p.communicate()
         return output.decode('utf-8').strip()
 
     def tag_fzf(self, options, selected, on_enter):
@@ -412,38 +707,54 @@ class Knowit():
         NOTE: influenced by https://jeskin.net/blog/grep-fzf-clp/
         NOTE: https://github.com/jpe90/clp is needed to be installed!
         """
-        fzf_options = "--listen 6266 "
+        from fzf import allocate_endpoint, LISTEN_ENV
+        from secrets import token_hex
+        # a listen port per session, so concurrent sessions don't collide.
+        # fzf_reload finds it through the environment fzf passes down.
+        endpoint = allocate_endpoint()
+
+        fzf_options = f"--listen {endpoint} "
         fzf_options += "--sync "
         fzf_options += "--layout reverse "
         fzf_options += "--border rounded "
         fzf_options += "--border-label-pos 3 "
-        fzf_options += f"--border-label \"{' '.join(selected)}\" "
+        fzf_options += f"--border-label \"{tag_query.label(selected)}\" "
         fzf_options += "--bind 'ctrl-z:toggle-preview' "
         fzf_options += f"--bind 'ctrl-t:become(python {path.abspath(__file__)} --cwd {self.args.cwd} -a create -t {{}})' "
         fzf_options += "--bind 'ctrl-k:preview-up' "
         fzf_options += "--bind 'ctrl-j:preview-down' "
         fzf_options += "--bind 'ctrl-u:preview-half-page-up' "
         fzf_options += "--bind 'ctrl-d:preview-half-page-down' "
-        fzf_options += f"--bind 'ctrl-g:become(python {path.abspath(__file__)} --cwd {self.args.cwd} -a grep -t {{}})' "
-        fzf_options += f"--bind 'esc:reload(python {path.abspath(__file__)} --cwd {self.args.cwd} -a fzf_reload --undo -t {{}})+clear-query' "
+        fzf_options += f"--bind 'ctrl-g:become(python {path.abspath(__file__)} --cwd {self.args.cwd} -a grep --search-backend {self.args.search_backend}{self.filter_options()} -t {{}})' "
+        fzf_options += f"--bind 'esc:reload(python {CLIENT} --cwd {self.args.cwd} -a fzf_reload --undo{self.filter_options()} -t {{}})+clear-query' "
+        fzf_options += f"--bind 'ctrl-x:reload(python {CLIENT} --cwd {self.args.cwd} -a fzf_reload --apply-query{self.filter_options()} -t {{}})+clear-query' "
         fzf_options += f"--bind 'enter:{on_enter}' "
         fzf_options += "--bind 'tab:toggle+clear-query' "
-        fzf_options += f"--bind 'tab:+reload(python {path.abspath(__file__)} --cwd {self.args.cwd} -a fzf_reload -t {{}})' "
+        fzf_options += f"--bind 'tab:+reload(python {CLIENT} --cwd {self.args.cwd} -a fzf_reload{self.filter_options()} -t {{}})' "
         fzf_options += "--tiebreak=index "
         fzf_options += "--preview-window 'down,80%' "
-        fzf_options += f"--preview 'python {path.abspath(__file__)} --cwd {self.args.cwd} -a fzf_preview --color -t {{}}'"
+        fzf_options += f"--preview 'python {CLIENT} --cwd {self.args.cwd} -a fzf_preview --color{self.filter_options()} -t {{}}'"
+
+        # reload/preview are answered by the daemon, start it ahead of time
+        from client import spawn_server
+        spawn_server(self.args.cwd)
 
         env = environ.copy()
         env["FZF_DEFAULT_OPTS"] = fzf_options
-        p = Popen(["fzf"],
-                  stdin=PIPE,
-                  stdout=PIPE,
-                  stderr=stderr,
-                  env=env)
-        # write the options to stdin before launching the pocess with communicate()
-        p.stdin.write("\n".join(options).encode())
-
-        output, errors = p.communicate()
+        env[LISTEN_ENV] = endpoint
+        # anyone local can reach the port, fzf only takes actions with the
+        # session's key (its children, fzf_reload, have it)
+        env["FZF_API_KEY"] = token_hex(16)
+        with span("subprocess", command="fzf"):
+            p = Popen(["fzf"],
+                      stdin=PIPE,
+                      stdout=PIPE,
+                      stderr=stderr,
+                      env=env)
+            # write the options to stdin before launching the pocess with communicate()
+            p.stdin.write("\n".join(options).encode())
+
+            output, errors = p.communicate()
         results = output.decode('utf-8').strip()
 
         return results.splitlines()
@@ -472,18 +783,22 @@ class Knowit():
         selected = self.args.tags
         assert len(selected) == 1
         selected, note_path = self.fzf_selected_parse(selected[0])
-        fzf_query = environ.get('FZF_QUERY', "")
-        fzf_label = environ.get('FZF_BORDER_LABEL', "")
+        fzf_query = self.env.get('FZF_QUERY', "")
+        fzf_label = self.env.get('FZF_BORDER_LABEL', "")
 
         tags = []
         if fzf_label:
-            tags = ''.join(fzf_label.split()) # remove all spaces
-            tags = tags.strip().split("#")
-            tags = [x for x in tags if x] # remove empty strings
+            tags = tag_query.terms(fzf_label)
 
         if self.args.undo:
             if len(tags) > 0:
                 tags.pop()
+        elif self.args.apply_query:
+            # the prompt holds a tag query, ANDed with the selection
+            try:
+                tags.extend(tag_query.terms(fzf_query))
+            except tag_query.QueryError as e:
+                log(f"ignoring the tag query {fzf_query!r}: {e}")
         else:
             # toggle
             if len(selected) == 1:
@@ -495,28 +810,21 @@ class Knowit():
                 tags.extend(selected)
         tags = list(dict.fromkeys(tags)) # preserve order!
 
-        tags_map = {}
-        relevant_notes = []
-        for note in self.notes:
-            if not set(tags).issubset(set(note.tags)): continue
-            relevant_notes.append(note)
-            for tag in note.tags:
-                if tag not in tags_map: tags_map[tag] = 0
-                tags_map[tag] += 1
-
-        # remove already selected tags
-        for tag in tags: del tags_map[tag]
-
-        if len(relevant_notes) > 1:
-            for tag, count in reversed(sorted(tags_map.items(), key=lambda x: x[1])):
-                print(f"#{tag} [{count}]", flush=True)
-        for note in relevant_notes:
-            print(f"{note.path} ({' '.join([f'#{tag}' for tag in note.tags])})")
+        for option in self._generate_options(tags):
+            self.out.write(f"{option}\n".encode())
+        self.out.flush()
 
-        fzf_label = " ".join([f"#{tag}" for tag in tags])
+        fzf_label = tag_query.label(tags)
 
         # we need to re-select the tags for fzf to continue from where we stopped
-        post("http://localhost:6266/", data=f"change-border-label({fzf_label})")
+        from fzf import get_client
+        client = get_client(self.env)
+        if client is None: return
+        try:
+            # the label may have parentheses, the argument goes to the end
+            client.send(f"change-border-label:{fzf_label}")
+        except OSError:
+            log(f"failed to update the fzf border label on {client.endpoint}")
 
     def fzf_preview(self):
         try:
@@ -524,46 +832,94 @@ class Knowit():
             assert len(selected) == 1
             selected, note_path = self.fzf_selected_parse(selected[0])
             if note_path:
-                note = Note.parse(note_path)
-                content = bat(note.summary()) if self.args.color else content.encode()
-                stdout.buffer.write(content)
+                st = note_stat(note_path)
+                key = self.preview_cache.key(self.args.color,
+                                             note_path,
+                                             [(note_path, (st.st_mtime_ns, st.st_size, st.st_ino))])
+                content = self.preview_cache.get(key)
+                if content is None:
+                    note = Note.parse(note_path)
+                    content = note.summary()
+                    content = bat(content) if self.args.color else content.encode()
+                    if content is not None: self.preview_cache.put(key, content)
+                self.out.write(content)
                 return
 
-            fzf_query = environ.get('FZF_QUERY', "")
-            fzf_label = environ.get('FZF_BORDER_LABEL', "")
+            fzf_query = self.env.get('FZF_QUERY', "")
+            fzf_label = self.env.get('FZF_BORDER_LABEL', "")
 
             tags = []
             if fzf_label:
-                tags = ''.join(fzf_label.split()) # remove all spaces
-                tags = tags.strip().split("#")
-                tags = [x for x in tags if x] # remove empty strings
+                tags = tag_query.terms(fzf_label)
 
             if not fzf_query or selected:
                 tags.extend(selected)
 
-            content = ""
-            prev_existed = False
-            relevant_notes = []
-            relevant_tags = tags.copy()
-            #TODO: use creation time to control order?
-            for note in self.notes:
-                if not set(tags).issubset(set(note.tags)): continue
-                relevant_notes.append(note)
-                relevant_tags.extend(note.tags)
-            relevant_tags = list(set(relevant_tags))
-
-            for note in relevant_notes:
-                if prev_existed: content += "\n---\n\n"
-
-                content += note.summary()
-                prev_existed = True
-
-            content = bat(content) if self.args.color else content.encode()
-            stdout.buffer.write(content)
+            relevant_notes = self.relevant_notes(tags)
+            # the daemon's notes lag the files by the watcher's delay, the
+            # notes the budget can render (every summary is 3 lines at least)
+            # are stat'ed now so an edit is never served from the cache
+            shown = self.args.preview_lines // 3 + 1
+            key = self.preview_cache.key(self.args.color,
+                                         (sorted(set(tags)), self.args.preview_lines, self.args.preview_bytes),
+                                         [(note.path, current_stat(note.path) if n < shown else note.stat)
+                                          for n, note in enumerate(relevant_notes)])
+            content = self.preview_cache.get(key)
+            if content is not None:
+                self.out.write(content)
+                return
+
+            with span("render", notes=len(relevant_notes)):
+                content = stream(self.preview_chunks(relevant_notes), self.out, self.args.color)
+            self.preview_cache.put(key, content)
         except:pass
 
+    def preview_chunks(self, notes):
+        """
+        the summaries of the notes (by time of creation), until the preview
+        budget (--preview-lines/--preview-bytes) is spent - fzf only shows
+        the first screen of it anyway.
+        """
+        lines = 0
+        size = 0
+        for n, note in enumerate(notes):
+            chunk = note.summary()
+            if n: chunk = "\n---\n\n" + chunk
+            yield chunk
+
+            lines += chunk.count("\n")
+            size += len(chunk)
+            if lines >= self.args.preview_lines or size >= self.args.preview_bytes:
+                rest = len(notes) - n - 1
+                if rest: yield f"\n---\n\n... {rest} more notes\n"
+                return
 
-def main():
+
+RELATIVE_TIME = re.compile(r"^(?P<count>\d+)(?P<unit>[mhdw])$")
+TIME_UNITS = {"m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+
+def time_arg(value, end=False):
+    """
+    epoch seconds of a --since/--until value: '@<epoch>', a date, a date and
+    time, or a time ago ('90m', '12h', '7d', '2w').
+    a date alone --until means the end of that day.
+    """
+    value = value.strip()
+    if value.startswith("@"): return int(value[1:])
+    m = RELATIVE_TIME.match(value)
+    if m:
+        ago = timedelta(**{TIME_UNITS[m.group('unit')]: int(m.group('count'))})
+        return to_epoch(datetime.now().replace(microsecond=0) - ago)
+    for time_format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            timestamp = datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+        if end and time_format == "%Y-%m-%d": timestamp += timedelta(days=1)
+        return to_epoch(timestamp)
+    raise argparse.ArgumentTypeError(f"invalid time '{value}'")
+
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-a',
                         '--action',
@@ -577,53 +933,150 @@ def main():
                                     "sync",
                                     "fzf_reload",
                                     "fzf_preview",
+                                    "search",
+                                    "query",
+                                    "pack",
+                                    "unpack",
+                                    "lint",
+                                    "serve",
+                                    "watch",
+                                    "stats",
                                 ],
                         help="the action to be perfomed")
 
     parser.add_argument('--cwd',
                         default=path.expanduser("~/notes"),
-                        help="this is the fzf query in case of fzf_reload action")
+                        help="the notes directory, several separated by ':' or a file listing them (see roots.py)")
     parser.add_argument('-t',
                         '--tags',
                         nargs='+',
                         default=[],
                         help="list of tags to perform action on.")
     parser.add_argument('--query',
-                        help="this is the fzf query in case of fzf_reload action")
+                        help="the query of the search action")
+    parser.add_argument('--search-backend',
+                        choices=["rg", "index"],
+                        default="rg",
+                        help="run rg on every grep query, or answer them from the search index")
     parser.add_argument('--undo',
                         action="store_true",
                         help="this is for the fzf_reload() to know it is an undo operation")
+    parser.add_argument('--apply-query',
+                        action="store_true",
+                        help="for fzf_reload(), add the tag query typed in the fzf prompt to the selection")
     parser.add_argument('--color',
                         action="store_true",
                         help="syntax highlight the results")
     parser.add_argument('--view-path',
                         help="the path to the view (vim) file with view into notes")
+    parser.add_argument('--since',
+                        type=time_arg,
+                        help="only notes created since (a date, 'YYYY-MM-DD HH:MM', or ago: 90m, 12h, 7d, 2w)")
+    parser.add_argument('--until',
+                        type=lambda value: time_arg(value, end=True),
+                        help="only notes created before (a date alone includes that day)")
+    parser.add_argument('--last',
+                        type=int,
+                        help="only the last (most recent) N notes")
+    parser.add_argument('--kind',
+                        choices=["notes", "tags", "links", "backlinks"],
+                        default="notes",
+                        help="what the query action lists: the notes, their other tags, their links or the links to them")
+    parser.add_argument('--format',
+                        choices=["ndjson", "tsv"],
+                        default="ndjson",
+                        help="output format of the query action")
+    parser.add_argument('--limit',
+                        type=int,
+                        help="list at most that many results (query action)")
+    parser.add_argument('--offset',
+                        type=int,
+                        default=0,
+                        help="skip that many results first (query action)")
+    parser.add_argument('--preview-lines',
+                        type=int,
+                        default=PREVIEW_LINES,
+                        help="stop rendering the preview of a tag selection after that many lines")
+    parser.add_argument('--preview-bytes',
+                        type=int,
+                        default=PREVIEW_BYTES,
+                        help="stop rendering the preview of a tag selection after that many bytes")
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        help="number of workers parsing notes on a cold start (default: cpu count, 1 to disable)")
+    parser.add_argument('--parse-executor',
+                        choices=["thread", "process"],
+                        default="thread",
+                        help="parse notes with threads (slow/network filesystems) or processes (cpu bound)")
+    parser.add_argument('--idle-timeout',
+                        type=float,
+                        default=600,
+                        help="seconds without requests before the 'serve' daemon exits")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    if args.action == "serve":
+        from server import serve
+        serve(args.cwd, args.idle_timeout, jobs=args.jobs, executor=args.parse_executor)
+        return
+
+    if args.action == "watch":
+        from watch import watch
+        watch(args.cwd, jobs=args.jobs, executor=args.parse_executor)
+        return
 
-    args = parser.parse_args()
-    knowit = Knowit(args)
-
-    if args.action == "create":
-        knowit.create()
-    if args.action == "browse":
-        knowit.browse()
-    if args.action == "link":
-        knowit.link()
-    if args.action == "view":
-        knowit.view()
-    if args.action == "grep":
-        knowit.grep()
-    if args.action == "sync":
-        knowit.sync()
-    if args.action == "tag":
-        knowit.tag()
-    if args.action == "fzf_preview":
-        knowit.fzf_preview()
-    if args.action == "fzf_reload":
-        knowit.fzf_reload()
+    if args.action == "stats":
+        tracing.print_stats(tracing.trace_path() or tracing.TRACE_FILE, stdout)
+        return
+
+    tracing.context['action'] = args.action
+    try:
+        run(args)
+    except tag_query.QueryError as e:
+        print(f"knowit: {e}", file=stderr)
+
+
+def run(args):
+    with span("action"):
+        knowit = Knowit(args)
+
+        if args.action == "create":
+            knowit.create()
+        if args.action == "browse":
+            knowit.browse()
+        if args.action == "link":
+            knowit.link()
+        if args.action == "view":
+            knowit.view()
+        if args.action == "grep":
+            knowit.grep()
+        if args.action == "sync":
+            knowit.sync()
+        if args.action == "tag":
+            knowit.tag()
+        if args.action == "fzf_preview":
+            knowit.fzf_preview()
+        if args.action == "fzf_reload":
+            knowit.fzf_reload()
+        if args.action == "search":
+            knowit.search()
+        if args.action == "query":
+            knowit.query()
+        if args.action == "pack":
+            knowit.pack()
+        if args.action == "unpack":
+            knowit.unpack()
+        if args.action == "lint":
+            knowit.lint()
 
 
 if __name__=="__main__":
     try:
         main()
     except:
+        import traceback
         log(traceback.format_exc())
@@ -0,0 +1,87 @@
+from os import path
+import re
+
+from pack import packed
+
+# every [name](target), a link never spans lines
+LINK = re.compile(r"\[(?P<name>[^\]\n]*)\]\((?P<path>[^)\s]+)\)")
+
+
+def parse_links(content):
+    """(name, target) of every link of the content lines, in one scan over all of them"""
+    return LINK.findall("".join(content))
+
+
+def resolve(note_path, link_path):
+    """
+    absolute path of a link of the note at note_path, None for a url.
+    relative links are relative to the note's directory.
+    """
+    if "://" in link_path or link_path.startswith("mailto:"): return None
+    link_path = link_path.split("#", 1)[0]
+    if not link_path: return None
+    return path.normpath(path.join(path.dirname(path.abspath(note_path)), path.expanduser(link_path)))
+
+
+def is_file(target):
+    """target is a file, a packed note is a file as well"""
+    return path.isfile(target) or packed(target) is not None
+
+
+class LinkGraph():
+    """
+    forward links and backlinks between the notes.
+
+    a link to another note is resolved by the note set itself. any other
+    target is checked on the filesystem the first time it is looked up and
+    remembered, until update() reports a change of that path (the daemon
+    passes every file the watcher saw created, changed or deleted). a
+    target outside of the watched roots is only checked once per graph.
+    """
+    def __init__(self, notes):
+        self.forward = {}
+        self.backward = {}
+        self.files = {}
+        for note in notes:
+            if note is not None: self.add(note)
+
+    def add(self, note):
+        note_path = path.abspath(note.path)
+        targets = [target for target in note.targets if target is not None]
+        for target in targets:
+            if target not in self.backward: self.backward[target] = set()
+            self.backward[target].add(note_path)
+        self.forward[note_path] = targets
+
+    def remove(self, note_path):
+        note_path = path.abspath(note_path)
+        for target in self.forward.pop(note_path, []):
+            sources = self.backward.get(target)
+            if sources is None: continue
+            sources.discard(note_path)
+            if not sources:
+                del self.backward[target]
+                self.files.pop(target, None)
+
+    def update(self, removed, notes):
+        """removed - paths of notes gone (or files deleted), notes - notes (re)parsed"""
+        for note_path in removed:
+            self.remove(note_path)
+            self.files.pop(path.abspath(note_path), None)
+        for note in notes:
+            self.remove(note.path)
+            self.add(note)
+            self.files.pop(path.abspath(note.path), None)
+
+    def resolved(self, target):
+        if target in self.forward: return True
+        if target not in self.files: self.files[target] = is_file(target)
+        return self.files[target]
+
+    def links(self, note_path):
+        """resolved targets the note links to"""
+        return [t for t in self.forward.get(path.abspath(note_path), []) if self.resolved(t)]
+
+    def backlinks(self, note_path):
+        """notes linking to note_path"""
+        return sorted(self.backward.get(path.abspath(note_path), ()))
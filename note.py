@@ -1,69 +1,303 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from os import fstat
+import mmap
+import sys
 import re
 
+from links import parse_links, resolve
+from pack import lookup, open_note
+
+# notes longer than that (lines) are previewed by their first line only
+MAX_PREVIEW = 200
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+HEADER = re.compile(r"^\[(?P<date>\d\d\d\d-\d\d\-\d\d\ \d\d:\d\d:\d\d)\]\s+(?P<tags>(\#[\w\-\.]+\s+)*)?$")
+
+# below that size (bytes) reading a note is cheaper than mapping it
+MMAP_THRESHOLD = 64 * 1024
+
+# timestamps are kept as whole seconds since EPOCH, naive like the note
+# headers - converting back never depends on the local timezone
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch(timestamp):
+    return (timestamp - EPOCH) // timedelta(seconds=1)
+
+
+class ParseError(Exception):
+    """a file that is not a valid note: where (line, None if unknown) and why"""
+    def __init__(self, path, line, reason):
+        super().__init__(f"{path}:{line}: {reason}")
+        self.path = path
+        self.line = line
+        self.reason = reason
+
+
+def parse_header(path, lines):
+    """
+    (epoch, tags) of the note whose first lines (header, empty line and
+    separator - decoded) are lines, raises ParseError.
+    """
+    m = HEADER.match(lines[0])
+    if m is None: raise ParseError(path, 1, "expected a '[YYYY-MM-DD HH:MM:SS] #tag ...' header")
+    date = m.group('date')
+    try:
+        timestamp = datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                             int(date[11:13]), int(date[14:16]), int(date[17:19]))
+    except ValueError:
+        raise ParseError(path, 1, f"invalid date {date}")
+    if lines[1] != "\n": raise ParseError(path, 2, "expected an empty line after the header")
+    if lines[2].rstrip("\n") != "---": raise ParseError(path, 3, "expected '---' after the header")
+
+    tags = [tag.strip() for tag in m.group('tags').strip().split('#')[1:]]
+    return to_epoch(timestamp), tags
+
+
+def scan(path, data):
+    """
+    the index record (see Note.record()) of the note in data (its bytes), in
+    a single pass: header, where the content starts, its length and every
+    link in it. raises ParseError.
+    """
+    lines = []
+    start = 0
+    for _ in range(3):
+        end = data.find(b"\n", start) + 1 or len(data)
+        lines.append(decode(data[start:end]))
+        start = end
+    epoch, tags = parse_header(path, lines)
+
+    text = decode(data[start:])
+    if not text: raise ParseError(path, 4, "no content after the header")
+    return {
+            'timestamp': epoch,
+            'tags': intern_tags(tags),
+            'targets': [resolve(path, link_path) for _, link_path in parse_links([text])],
+            'offset': start,
+            'length': text.count("\n") + (not text.endswith("\n")),
+            }
+
+
+def parse_record(path):
+    """the index record of the note at path, reading it once (see scan())"""
+    with open_note(path) as f:
+        return scan(path, f.read())
+
+
+def intern_tags(tags):
+    """tags are shared by many notes, every note refers to the same strings"""
+    return tuple(sys.intern(tag) for tag in tags)
+
+
+def decode(data):
+    return data.decode(errors="replace").replace("\r\n", "\n")
+
+
+def content_head(path, offset, max_lines):
+    """
+    (text, lines) of the content of the note at path (starting at offset,
+    after the header when None): all of it if it has at most max_lines
+    lines, and lines is their number - otherwise only its first line, and
+    lines is None.
+    big notes are memory mapped and only the bytes needed are touched, a
+    preview of a huge note costs the same as one of a small note. a packed
+    note is a slice [base, end) of its (mapped) pack.
+    """
+    mapped = None
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        pack = lookup(path)
+        if pack is None: raise
+        data = pack.data
+        base, end = pack.span(path)
+    else:
+        with f:
+            if fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+                data = mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+        base, end = 0, len(data)
+    try:
+        start = base
+        if offset is None:
+            for _ in range(3): start = data.find(b"\n", start, end) + 1 or end
+        else:
+            start = base + offset
+
+        stop = start
+        lines = 0
+        while lines < max_lines and stop < end:
+            stop = data.find(b"\n", stop, end) + 1 or end
+            lines += 1
+        if stop >= end: return decode(data[start:end]), lines
+
+        first = data.find(b"\n", start, end) + 1 or end
+        return decode(data[start:first]), None
+    finally:
+        if mapped is not None: mapped.close()
+
 
 class Note():
+    """
+    a note is parsed lazily: only its header is read when it is parsed, the
+    content (and the links in it) is read from the file on first access.
+
+    the daemon keeps every note in memory, so a note is kept small: slots,
+    the timestamp as an int (epoch), the tags as a tuple of interned strings
+    and, instead of its content, the offset the content starts at in the file.
+    """
+    __slots__ = ("path",
+                 "epoch",
+                 "tags",
+                 "stat",
+                 "offset",
+                 "_links",
+                 "_content",
+                 "_first_line",
+                 "_length",
+                 "_targets")
+
     def __init__(self,
                  path,
                  timestamp,
                  tags,
                  links,
-                 content):
+                 content,
+                 first_line=None,
+                 length=None,
+                 stat=None,
+                 targets=None,
+                 offset=None):
         self.path = path
-        self.timestamp = timestamp
-        self.tags = tags
-        self.links = links
-        self.content = content
+        self.epoch = timestamp if isinstance(timestamp, int) else to_epoch(timestamp)
+        self.tags = intern_tags(tags)
+        self._links = links
+        self._content = content
+        # first content line and number of content lines, when they are known
+        # without reading the note
+        self._first_line = first_line
+        self._length = length
+        # (mtime, size, inode) of the file when it was indexed
+        self.stat = stat
+        # position of the content in the file (bytes)
+        self.offset = offset
+        self._targets = targets
+        if content is not None:
+            self._first_line = content[0] if content else ""
+            self._length = len(content)
 
-    def __str__(self):
-        timestamp_str = self.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        to_str = f"[{timestamp_str}]"
-        for tag in self.tags: to_str += f" #{tag}"
-        to_str += "\n"
-        to_str += "\n" + "---" + "\n"
-        to_str += "".join(self.content)
-        return to_str
+    @property
+    def timestamp(self):
+        return EPOCH + timedelta(seconds=self.epoch)
 
-    def summary(self):
-        timestamp_str = self.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        to_str = f"[{timestamp_str}]"
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        self.epoch = to_epoch(timestamp)
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = self.read_content()
+        return self._content
+
+    @property
+    def first_line(self):
+        if self._first_line is not None: return self._first_line
+        return content_head(self.path, self.offset, 0)[0]
+
+    @property
+    def links(self):
+        if self._links is None:
+            self._links = parse_links(self.content)
+        return self._links
+
+    @property
+    def targets(self):
+        """absolute path per link (None for a url), see links.resolve()"""
+        if self._targets is None:
+            self._targets = [resolve(self.path, link_path) for _, link_path in self.links]
+        return self._targets
+
+    @property
+    def length(self):
+        if self._length is None:
+            self._length = len(self.content)
+        return self._length
+
+    def read_content(self):
+        """content lines of the note, without keeping them around"""
+        if self._content is not None: return self._content
+        with open_note(self.path, 'r') as f:
+            if self.offset is None: return f.readlines()[3:]
+            f.seek(self.offset)
+            return f.readlines()
+
+    def header(self):
+        to_str = f"[{self.timestamp.strftime(TIMESTAMP_FORMAT)}]"
         for tag in self.tags: to_str += f" #{tag}"
         to_str += "\n"
         to_str += "\n" + "---" + "\n"
-        MAX_PREVIEW = 200
-        if len(self.content) > MAX_PREVIEW:
-            to_str += self.content[0]
-        else:
-            to_str += "".join(self.content)
         return to_str
 
-    def dump(self):
-        open(self.path, 'w').write(str(self))
+    def __str__(self):
+        return self.header() + "".join(self.content)
 
-    @staticmethod
-    def parse(path):
-        lines = open(path, 'r').readlines()
-        assert len(lines) > 3
+    def summary(self):
+        to_str = self.header()
+        if self._length is not None and self._length > MAX_PREVIEW:
+            to_str += self.first_line
+            return to_str
 
-        m = re.match(r"^\[(?P<date>\d\d\d\d-\d\d\-\d\d\ \d\d:\d\d:\d\d)\]\s+(?P<tags>(\#[\w\-\.]+\s+)*)?$", lines[0])
-        assert m is not None
+        if self._content is not None:
+            content = self._content
+            to_str += content[0] if len(content) > MAX_PREVIEW else "".join(content)
+            return to_str
 
-        assert len(lines[1]) == 1
+        text, lines = content_head(self.path, self.offset, MAX_PREVIEW)
+        if lines is not None: self._length = lines
+        return to_str + text
 
-        timestamp = datetime.strptime(m.group('date'), "%Y-%m-%d %H:%M:%S")
-        tags = m.group('tags').strip().split('#')[1:]
-        tags = [tag.strip() for tag in tags]
+    def record(self):
+        """the note as kept in the index file (see index.py)"""
+        return {
+                'timestamp': self.epoch,
+                'tags': self.tags,
+                'targets': self.targets,
+                'offset': self.offset,
+                'length': self.length,
+                }
 
-        m = re.match(r"^---$", lines[2])
-        assert m is not None
+    @staticmethod
+    def from_record(path, record, stat=None):
+        # link targets are shared by the notes linking to them as well
+        targets = tuple(target if target is None else sys.intern(target) for target in record['targets'])
+        return Note(path,
+                    record['timestamp'],
+                    record['tags'],
+                    None,
+                    None,
+                    length=record['length'],
+                    stat=stat,
+                    targets=targets,
+                    offset=record['offset'])
 
-        content = lines[3:]
-        links = []
-        for line in content:
-            m = re.match(r"^.*\[(?P<name>.*?)\]\((?P<path>.*)\).*$", line)
-            if m is None: continue
-            link_name = m.group('name')
-            link_path = m.group('path')
-            links.append((link_name, link_path))
+    def dump(self):
+        from store import write_atomic
+        write_atomic(self.path, str(self))
 
-        return Note(path, timestamp, tags, links, content)
+    @staticmethod
+    def parse(path):
+        """parse the header of the note, the content is read on demand. raises ParseError"""
+        with open_note(path) as f:
+            # header, empty line, separator and the first content line
+            lines = [f.readline() for _ in range(4)]
+        # where the content starts, in bytes
+        offset = len(lines[0]) + len(lines[1]) + len(lines[2])
+        lines = [decode(line) for line in lines]
+        epoch, tags = parse_header(path, lines)
+        first_line = lines[3]
+        if first_line == "": raise ParseError(path, 4, "no content after the header")
+        return Note(path, epoch, tags, None, None, first_line=first_line, offset=offset)
@@ -0,0 +1,290 @@
+"""
+packs bundle cold notes into a single file, so a big notes directory isn't
+a walk over (and an open of) thousands of small files.
+
+    [header][note][note]...[index]
+
+the header holds a magic, the format version and where the index is, the
+notes are their files' bytes as is and the index is a json list of
+[name, offset, size, mtime_ns] - name relative to the directory of the pack.
+a pack is memory mapped and a note is a slice of it. only the packs right
+in a notes root (see set_roots()) are used, a pack anywhere else is left
+alone.
+
+a packed note keeps the path it had as a file (the pack's directory joined
+with its name), links to and from it keep working and everything reading
+notes goes through open_note(). a file at that path shadows the packed
+note. editing a packed note moves it out of the pack first (see extract()).
+
+`knowit.py -a pack` moves the notes of the tags into the pack of their root
+(PACK_FILE), `-a unpack` moves them back to files.
+"""
+from os import listdir, fstat, stat, replace, remove, utime, getpid, path
+from stat import S_IFREG
+from io import BytesIO, TextIOWrapper
+import struct
+import mmap
+import json
+import sys
+
+PACK_SUFFIX = ".knowpack"
+PACK_FILE = f"archive{PACK_SUFFIX}"
+PACK_VERSION = 1
+MAGIC = b"KNOWPACK"
+HEADER = struct.Struct("<8sIQQ")
+
+# the packs opened so far (by path) and the pack of every packed note
+packs = {}
+members = {}
+# the notes roots, and those already looked into for packs (see lookup())
+roots = []
+searched = set()
+
+
+def is_pack(file_path):
+    return file_path.endswith(PACK_SUFFIX)
+
+
+def at_root(pack_path, root):
+    """pack_path is a pack right in root, one that is used"""
+    return is_pack(pack_path) and path.dirname(path.abspath(pack_path)) == path.abspath(root)
+
+
+def set_roots(directories):
+    """the notes roots of this process, the only places packs are looked up"""
+    roots[:] = directories
+
+
+def root_of(file_path):
+    """the (innermost) notes root file_path is under, None if it is under none"""
+    file_path = path.abspath(file_path)
+    found = [root for root in roots if file_path.startswith(path.join(path.abspath(root), ""))]
+    return max(found, key=lambda root: len(path.abspath(root)), default=None)
+
+
+class MemberStat():
+    """stat of a packed note, what NoteIndex compares to re-validate it"""
+    __slots__ = ("st_mtime_ns", "st_size", "st_ino", "st_mode")
+
+    def __init__(self, mtime_ns, size):
+        self.st_mtime_ns = mtime_ns
+        self.st_size = size
+        self.st_ino = 0
+        self.st_mode = S_IFREG | 0o444
+
+
+class Pack():
+    def __init__(self, pack_path):
+        self.path = pack_path
+        self.directory = path.dirname(pack_path)
+        with open(pack_path, 'rb') as f:
+            st = fstat(f.fileno())
+            self.stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+            if st.st_size < HEADER.size: raise ValueError(f"{pack_path} is not a pack")
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, index_offset, index_size = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != PACK_VERSION: raise ValueError(f"{pack_path} is not a pack")
+        index = json.loads(self.data[index_offset:index_offset + index_size])
+        self.members = {}
+        prefix = path.join(path.abspath(self.directory), "")
+        for name, offset, size, mtime_ns in index:
+            member = path.join(self.directory, name)
+            # a pack only holds notes under its own directory
+            if not path.abspath(member).startswith(prefix): continue
+            self.members[member] = (offset, size, mtime_ns)
+
+    def span(self, member):
+        """(start, end) of the bytes of member in data"""
+        offset, size, _ = self.members[member]
+        return offset, offset + size
+
+    def read(self, member):
+        start, end = self.span(member)
+        return self.data[start:end]
+
+    def member_stat(self, member):
+        _, size, mtime_ns = self.members[member]
+        return MemberStat(mtime_ns, size)
+
+
+def open_pack(pack_path, st=None):
+    """the (registered) Pack at pack_path, None if there is no valid pack there"""
+    try:
+        st = st if st is not None else stat(pack_path)
+    except OSError:
+        forget(pack_path)
+        return None
+    pack = packs.get(pack_path)
+    if pack is not None and pack.stat == (st.st_mtime_ns, st.st_size, st.st_ino): return pack
+
+    forget(pack_path)
+    try:
+        pack = Pack(pack_path)
+    except (OSError, ValueError):
+        return None
+    packs[pack_path] = pack
+    for member in pack.members: members[member] = pack
+    return pack
+
+
+def forget(pack_path):
+    # the mapping is closed once nothing refers to it anymore
+    pack = packs.pop(pack_path, None)
+    if pack is None: return
+    for member in pack.members:
+        if members.get(member) is pack: del members[member]
+
+
+def packed(file_path):
+    """the registered Pack holding file_path, if any (shadowed or not)"""
+    return members.get(file_path)
+
+
+def lookup(file_path):
+    """
+    the Pack holding file_path, looking for packs in the notes root of it
+    when none is registered yet (a process that didn't scan the notes).
+    paths outside of the roots are never packed.
+    """
+    pack = members.get(file_path)
+    if pack is not None: return pack
+    root = root_of(file_path)
+    if root is None or root in searched: return None
+    searched.add(root)
+    try:
+        names = listdir(root)
+    except OSError:
+        names = []
+    for name in names:
+        if is_pack(name): open_pack(path.join(root, name))
+    return members.get(file_path)
+
+
+def open_note(file_path, mode='rb'):
+    """the note at file_path opened for reading, a file or packed"""
+    try:
+        return open(file_path, mode)
+    except FileNotFoundError:
+        pack = lookup(file_path)
+        if pack is None: raise
+    f = BytesIO(pack.read(file_path))
+    return f if 'b' in mode else TextIOWrapper(f)
+
+
+def note_stat(file_path):
+    try:
+        return stat(file_path)
+    except FileNotFoundError:
+        pack = lookup(file_path)
+        if pack is None: raise
+        return pack.member_stat(file_path)
+
+
+def exists(file_path):
+    return path.exists(file_path) or lookup(file_path) is not None
+
+
+def extract(file_path):
+    """
+    move a packed note out of its pack into its file (see unpack_notes()) -
+    for editing it. the note is a plain file from then on, deleting it
+    deletes the note, there's no packed copy left behind to come back.
+    """
+    if path.exists(file_path): return
+    pack = lookup(file_path)
+    if pack is None: return
+    unpack_notes(pack.path, [file_path])
+
+
+def write_file(file_path, data, mtime_ns):
+    tmp_path = f"{file_path}.{getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        utime(tmp_path, ns=(mtime_ns, mtime_ns))
+        replace(tmp_path, file_path)
+    except BaseException:
+        if path.exists(tmp_path): remove(tmp_path)
+        raise
+
+
+def write_pack(pack_path, notes):
+    """
+    write a pack of notes ((path, data, mtime_ns) each) at pack_path,
+    through a temporary file and a rename.
+    """
+    directory = path.dirname(pack_path)
+    tmp_path = f"{pack_path}.{getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(b"\0" * HEADER.size)
+            index = []
+            offset = HEADER.size
+            for note_path, data, mtime_ns in notes:
+                f.write(data)
+                index.append([path.relpath(note_path, directory), offset, len(data), mtime_ns])
+                offset += len(data)
+            index = json.dumps(index).encode()
+            f.write(index)
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, PACK_VERSION, offset, len(index)))
+        replace(tmp_path, pack_path)
+    except BaseException:
+        if path.exists(tmp_path): remove(tmp_path)
+        raise
+
+
+def kept(pack, moved):
+    """the notes of pack (as write_pack() takes them), but those in moved or shadowed by a file"""
+    if pack is None: return
+    for member, (offset, size, mtime_ns) in pack.members.items():
+        if member in moved or path.exists(member): continue
+        yield member, pack.data[offset:offset + size], mtime_ns
+
+
+def pack_notes(pack_path, paths):
+    """move the note files of paths into the pack at pack_path, return the paths packed"""
+    directory = path.dirname(pack_path) + path.sep
+    paths = [p for p in paths if p.startswith(directory) and path.isfile(p)]
+    if not paths: return []
+
+    def files():
+        for note_path in paths:
+            with open(note_path, 'rb') as f:
+                yield note_path, f.read(), fstat(f.fileno()).st_mtime_ns
+
+    pack = open_pack(pack_path) if path.exists(pack_path) else None
+    moved = set(paths)
+    write_pack(pack_path, [*kept(pack, moved), *files()])
+    for note_path in paths: remove(note_path)
+    open_pack(pack_path)
+    return paths
+
+
+def unpack_notes(pack_path, paths):
+    """move the notes of paths out of the pack at pack_path into files, return the paths unpacked"""
+    pack = open_pack(pack_path)
+    if pack is None: return []
+    paths = [p for p in paths if p in pack.members and not path.exists(p)]
+    if not paths: return []
+
+    for note_path in paths:
+        write_file(note_path, pack.read(note_path), pack.members[note_path][2])
+    rest = list(kept(pack, set(paths)))
+    if rest:
+        write_pack(pack_path, rest)
+        open_pack(pack_path)
+    else:
+        remove(pack_path)
+        forget(pack_path)
+    return paths
+
+
+if __name__ == "__main__":
+    # print a note of the roots of --cwd (sys.argv[2]), a file or packed
+    # (the grep preview of packed notes)
+    from roots import parse_roots
+    set_roots(parse_roots(sys.argv[2]))
+    with open_note(sys.argv[1]) as f:
+        sys.stdout.buffer.write(f.read())
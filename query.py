@@ -0,0 +1,128 @@
+"""
+headless queries over the notes, for scripts and other tools - no fzf, bat
+or nvim involved.
+
+    from query import Query
+    q = Query.open("~/notes")              # or "~/notes:~/team/notes"
+    for record in q.notes(["oncall"], since=..., limit=20): ...
+    for record in q.notes("#oncall (#db OR #cache) NOT #resolved"): ...
+    for record in q.tags(["oncall"]): ...     # the tags co-occurring, by count
+    for record in q.links(["oncall"]): ...    # the links of the notes
+    for record in q.backlinks(["oncall"]): ...  # the links to the notes
+
+or `python knowit.py -a query [--kind notes|tags|links|backlinks] [-t <tag>...]
+[--format ndjson|tsv] [--limit N] [--offset N]`.
+
+records are dicts produced one at a time, so exporting all of a big corpus
+doesn't build it in memory.
+"""
+from itertools import islice
+import json
+
+from note import TIMESTAMP_FORMAT
+import tag_query
+
+COLUMNS = {
+    "notes": ["path", "timestamp", "tags", "lines"],
+    "tags": ["tag", "count"],
+    "links": ["source", "target", "exists"],
+    "backlinks": ["source", "target"],
+}
+
+# output is written in batches of about that size
+WRITE_BUFFER = 64 * 1024
+
+
+def page(records, offset=0, limit=None):
+    return islice(records, offset, None if limit is None else offset + limit)
+
+
+class Query():
+    def __init__(self, tag_index, link_graph=None):
+        self.tag_index = tag_index
+        self._link_graph = link_graph
+
+    @property
+    def link_graph(self):
+        if self._link_graph is None:
+            from links import LinkGraph
+            self._link_graph = LinkGraph(self.tag_index.notes)
+        return self._link_graph
+
+    @staticmethod
+    def open(cwd, jobs=None):
+        """a Query over the notes under cwd, one or several roots (see roots.py)"""
+        from roots import Roots
+        from tag_index import TagIndex
+        roots = Roots(cwd, jobs=jobs)
+        roots.refresh()
+        return Query(TagIndex(roots.notes()))
+
+    def ids(self, tags=(), since=None, until=None, last=None):
+        """tags - a tag query (see tag_query.py), a string or a list of strings"""
+        return self.tag_index.match(tag_query.parse(tags), since, until, last)
+
+    def notes(self, tags=(), since=None, until=None, last=None, offset=0, limit=None):
+        """the notes matching the tags, oldest first"""
+        def records():
+            for i in self.ids(tags, since, until, last):
+                note = self.tag_index.notes[i]
+                yield {"path": note.path,
+                       "timestamp": note.timestamp.strftime(TIMESTAMP_FORMAT),
+                       "tags": list(note.tags),
+                       "lines": note.length}
+        return page(records(), offset, limit)
+
+    def tags(self, tags=(), since=None, until=None, last=None, offset=0, limit=None):
+        """the other tags of the notes matching the tags, most common first"""
+        selected = set(tag_query.tags(tag_query.parse(tags)))
+        facets = self.tag_index.facets(self.ids(tags, since, until, last))
+        for tag in selected: facets.pop(tag, None)
+        ranked = sorted(facets.items(), key=lambda x: (-x[1], x[0]))
+        return page(({"tag": tag, "count": count} for tag, count in ranked), offset, limit)
+
+    def links(self, tags=(), since=None, until=None, last=None, offset=0, limit=None):
+        """the links of the notes matching the tags (urls excluded)"""
+        def records():
+            for i in self.ids(tags, since, until, last):
+                note = self.tag_index.notes[i]
+                for target in note.targets:
+                    if target is None: continue
+                    yield {"source": note.path, "target": target, "exists": self.link_graph.resolved(target)}
+        return page(records(), offset, limit)
+
+    def backlinks(self, tags=(), since=None, until=None, last=None, offset=0, limit=None):
+        """the links from other notes to the notes matching the tags"""
+        def records():
+            for i in self.ids(tags, since, until, last):
+                note = self.tag_index.notes[i]
+                for source in self.link_graph.backlinks(note.path):
+                    yield {"source": source, "target": note.path}
+        return page(records(), offset, limit)
+
+
+def tsv_value(value):
+    if isinstance(value, (list, tuple)): value = " ".join(str(v) for v in value)
+    return str(value).replace("\t", " ").replace("\n", " ")
+
+
+def write(records, out, kind, output_format="ndjson"):
+    """write the records to out (binary) as ndjson or tsv (with a header line)"""
+    chunk = []
+    size = 0
+    if output_format == "tsv":
+        columns = COLUMNS[kind]
+        chunk.append("\t".join(columns) + "\n")
+        lines = ("\t".join(tsv_value(record[c]) for c in columns) + "\n" for record in records)
+    else:
+        lines = (json.dumps(record) + "\n" for record in records)
+
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= WRITE_BUFFER:
+            out.write("".join(chunk).encode())
+            chunk = []
+            size = 0
+    out.write("".join(chunk).encode())
+    out.flush()
@@ -0,0 +1,90 @@
+"""
+a notes collection can span several roots: --cwd takes directories separated
+by ':' (like PATH), or a file listing them, one per line.
+
+    --cwd ~/notes:~/team/notes:~/shared/notes
+    --cwd ~/.knowit-roots
+
+every root has its own index (in its own .knowit), the roots are indexed in
+parallel and their notes merged. the first root is the primary one: new
+notes, views, previews and the search index go there.
+"""
+from collections import ChainMap
+from os import path, pathsep, sep
+from threading import Thread
+from time import monotonic
+
+from index import NoteIndex
+from pack import set_roots
+
+
+def parse_roots(cwd):
+    """the roots of --cwd"""
+    if path.isfile(path.expanduser(cwd)):
+        with open(path.expanduser(cwd), 'r') as f:
+            names = [line.strip() for line in f if not line.strip().startswith("#")]
+    else:
+        names = cwd.split(pathsep)
+    roots = [path.expanduser(name) for name in names if name.strip()]
+    return list(dict.fromkeys(roots))
+
+
+def primary_root(cwd):
+    roots = parse_roots(cwd)
+    return roots[0] if roots else cwd
+
+
+class Roots():
+    """the indexes of the roots of a collection, used like a single NoteIndex"""
+    def __init__(self, cwd, jobs=None, executor="thread"):
+        self.roots = parse_roots(cwd)
+        self.primary = self.roots[0]
+        set_roots(self.roots)
+        self.indexes = [NoteIndex(root, jobs=jobs, executor=executor) for root in self.roots]
+        # a view over the entries of all of them (see SearchIndex.refresh)
+        self.entries = ChainMap(*[index.entries for index in self.indexes])
+
+    @staticmethod
+    def load(index):
+        index.load()
+        index.refresh()
+        index.save()
+
+    def refresh(self, timeout=None, on_ready=None):
+        """
+        load and re-validate the index of every root, each on its own thread.
+        on_ready(index) is called (from its thread) as every root is done.
+        waits up to timeout seconds (None: until all are done), return the
+        indexes that are done.
+        """
+        if len(self.indexes) == 1 and timeout is None and on_ready is None:
+            self.load(self.indexes[0])
+            return list(self.indexes)
+
+        done = []
+        def load(index):
+            self.load(index)
+            done.append(index)
+            if on_ready is not None: on_ready(index)
+
+        threads = [Thread(target=load, args=(index,), daemon=True) for index in self.indexes]
+        for thread in threads: thread.start()
+        deadline = None if timeout is None else monotonic() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - monotonic()))
+        return list(done)
+
+    def index_of(self, file_path):
+        """the index of the root file_path is under"""
+        best = None
+        for index in self.indexes:
+            prefix = index.root.rstrip(sep) + sep
+            if file_path == index.root or file_path.startswith(prefix):
+                if best is None or len(index.root) > len(best.root): best = index
+        return best
+
+    def notes(self, indexes=None):
+        notes = []
+        for index in (self.indexes if indexes is None else indexes):
+            notes.extend(index.notes())
+        return notes
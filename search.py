@@ -0,0 +1,164 @@
+from os import makedirs, replace, getpid, path
+import json
+import re
+
+from index import INDEX_DIR
+from pack import open_note
+
+SEARCH_FILE = "search.json"
+SEARCH_VERSION = 1
+
+WORD = re.compile(r"\w+")
+
+
+def trigrams(word):
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+class SearchIndex():
+    """
+    full text index of the notes content, an alternative to running rg over
+    the notes on every query.
+
+    the words of every note are persisted (with the stat they were read at)
+    next to the note index, and updated from its entries so only changed
+    notes are read again. in memory, every word maps to the notes having it
+    and the vocabulary is indexed by trigrams - a query only touches the
+    words containing its terms and the notes having those words.
+
+    queries are literal strings (not regexes), with rg's --smart-case.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.path = path.join(root, INDEX_DIR, SEARCH_FILE)
+        self.files = {}
+        self.dirty = False
+        self.postings = None
+        self.vocabulary = None
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != SEARCH_VERSION: return
+        self.files = data.get('files', {})
+
+    def save(self):
+        if not self.dirty: return
+        try:
+            makedirs(path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': SEARCH_VERSION, 'files': self.files}, f)
+            replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError:
+            pass
+
+    @staticmethod
+    def words(file_path):
+        try:
+            with open_note(file_path, 'r') as f:
+                return sorted(set(WORD.findall(f.read().lower())))
+        except (OSError, UnicodeDecodeError):
+            return []
+
+    def refresh(self, entries, paths=None):
+        """
+        bring the index up to date with the entries of a NoteIndex, using the
+        stat it already has instead of touching the filesystem.
+        paths - only these paths changed (all of them when None).
+        """
+        if paths is None: paths = set(entries) | set(self.files)
+        for file_path in paths:
+            entry = entries.get(file_path)
+            if entry is None or entry[1] is None:
+                if file_path in self.files: self.update(file_path, None, None)
+                continue
+            file_stat = list(entry[0])
+            current = self.files.get(file_path)
+            if current is not None and current['stat'] == file_stat: continue
+            self.update(file_path, file_stat, self.words(file_path))
+
+    def update(self, file_path, stat, words):
+        """replace the words of file_path (remove it when words is None)"""
+        self.dirty = True
+        old = self.files.pop(file_path, None)
+        if words is not None: self.files[file_path] = {'stat': stat, 'words': words}
+        if self.postings is None: return
+
+        if old is not None:
+            for word in old['words']:
+                self.postings[word].discard(file_path)
+        if words is not None:
+            self.add(file_path, words)
+
+    def add(self, file_path, words):
+        for word in words:
+            if word not in self.postings:
+                self.postings[word] = set()
+                for trigram in trigrams(word):
+                    if trigram not in self.vocabulary: self.vocabulary[trigram] = set()
+                    self.vocabulary[trigram].add(word)
+            self.postings[word].add(file_path)
+
+    def build(self):
+        """build the in memory postings, once per process"""
+        if self.postings is not None: return
+        self.postings = {}
+        self.vocabulary = {}
+        for file_path, entry in self.files.items():
+            self.add(file_path, entry['words'])
+
+    def matching_words(self, term):
+        grams = trigrams(term)
+        if not grams:
+            # too short for trigrams, fall back to the whole vocabulary
+            return [word for word in self.postings if term in word]
+
+        candidates = None
+        for gram in sorted(grams, key=lambda g: len(self.vocabulary.get(g, ()))):
+            words = self.vocabulary.get(gram)
+            if not words: return []
+            candidates = set(words) if candidates is None else candidates & words
+            if not candidates: return []
+        return [word for word in candidates if term in word]
+
+    def candidates(self, query):
+        """paths of the notes that may contain query"""
+        self.build()
+        terms = WORD.findall(query.lower())
+        if not terms: return set(self.files)
+
+        result = None
+        for term in sorted(set(terms), key=len, reverse=True):
+            paths = set()
+            for word in self.matching_words(term):
+                paths |= self.postings[word]
+            result = paths if result is None else result & paths
+            if not result: break
+        return result
+
+    def search(self, query, paths=None, extra=()):
+        """
+        yield rg like 'path:line:column:text' lines matching query.
+        paths - restrict the search to these notes (all when None).
+        extra - files outside the index to scan as well (linked files).
+        """
+        if not query: return
+        candidates = self.candidates(query)
+        if paths is not None: candidates &= paths
+
+        ignore_case = query == query.lower()
+        needle = query.lower() if ignore_case else query
+        for file_path in sorted(candidates) + [p for p in extra if p not in candidates]:
+            try:
+                with open_note(file_path, 'r') as f:
+                    for i, line in enumerate(f, start=1):
+                        col = (line.lower() if ignore_case else line).find(needle)
+                        if col == -1: continue
+                        yield f"{file_path}:{i}:{col + 1}:{line.rstrip()}"
+            except (OSError, UnicodeDecodeError):
+                continue
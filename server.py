@@ -0,0 +1,182 @@
+from socketserver import UnixStreamServer, StreamRequestHandler
+from os import remove, chmod, fstat, stat, close, open as os_open, O_WRONLY, O_CREAT, O_NOFOLLOW, path
+from threading import Lock
+from time import monotonic
+import traceback
+import fcntl
+import json
+
+from knowit import Knowit, build_parser, log
+from client import socket_path
+from roots import Roots
+from tag_index import TagIndex
+from cache import PreviewCache
+from search import SearchIndex
+from watch import Watcher
+from links import LinkGraph
+import tracing
+from tracing import span
+
+# actions the daemon answers, everything else goes through knowit.py
+SERVED_ACTIONS = ["fzf_reload", "fzf_preview", "search", "query"]
+
+# seconds the daemon waits for the index of every root before answering,
+# roots taking longer are merged in when they are ready
+ROOT_TIMEOUT = 1.0
+
+
+class KnowitHandler(StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        # written to the client as it is produced
+        self.server.dispatch(request['argv'], request['env'], self.wfile)
+
+
+class KnowitServer(UnixStreamServer):
+    """
+    long lived process keeping the parsed notes in memory, answering the
+    fzf_reload/fzf_preview requests sent by client.py over a unix socket.
+    it exits after idle_timeout seconds without requests.
+
+    the notes are kept up to date by a watcher (watch.py), which hands over
+    the changed paths so only those are re-parsed.
+
+    every root (see roots.py) is indexed on its own thread and has its own
+    watcher: a root is merged in as soon as it is indexed, without waiting
+    for the others, and a change only touches the index of its root.
+    """
+    # poll interval of handle_request(), to check for the idle timeout
+    timeout = 1.0
+
+    def __init__(self, cwd, idle_timeout, jobs=None, executor="thread"):
+        self.cwd = cwd
+        self.idle_timeout = idle_timeout
+        self.roots = Roots(cwd, jobs=jobs, executor=executor)
+        self.ready = []
+        self.tag_index = TagIndex([])
+        self.link_graph = LinkGraph([])
+        self.preview_cache = PreviewCache()
+        # built on the first search request, grep with the rg backend never
+        # needs it
+        self.search_index = None
+        self.last_request = monotonic()
+        # requests and watcher updates don't interleave
+        self.lock = Lock()
+        self.watchers = []
+        self.roots.refresh(timeout=ROOT_TIMEOUT, on_ready=self.on_ready)
+        super().__init__(socket_path(cwd), KnowitHandler)
+
+    def server_bind(self):
+        super().server_bind()
+        # only we may connect, whatever the umask
+        chmod(self.server_address, 0o600)
+
+    def on_ready(self, index):
+        """the index of a root is loaded, merge its notes in and watch it"""
+        with self.lock:
+            self.ready.append(index)
+            # rebuilt rather than updated: a whole root comes in out of order
+            self.tag_index = TagIndex(self.roots.notes(self.ready))
+            self.link_graph = LinkGraph(self.tag_index.notes)
+            self.preview_cache.entries.clear()
+            if self.search_index is not None:
+                self.search_index.refresh(self.roots.entries, set(index.entries))
+                self.search_index.save()
+            watcher = Watcher(index.root, lambda paths: self.on_change(index, paths))
+            watcher.start()
+            self.watchers.append(watcher)
+
+    def on_change(self, index, paths):
+        """paths of the root of index changed on disk (None: anything may have)"""
+        with self.lock:
+            # traced according to the daemon's own environment
+            tracing.configure()
+            tracing.context.clear()
+            tracing.context['action'] = "watch"
+            try:
+                with span("update", paths=-1 if paths is None else len(paths)):
+                    self.update(index, paths)
+            except Exception:
+                log(traceback.format_exc())
+
+    def update(self, index, paths):
+        if paths is None:
+            changed, removed = index.refresh()
+        else:
+            changed, removed = index.update(paths)
+        if not changed and not removed: return
+
+        notes = {p: index.note(p) for p in changed}
+        # changed files that are not (valid) notes anymore go as well
+        gone = removed + [p for p, note in notes.items() if note is None]
+        notes = [note for note in notes.values() if note is not None]
+        self.tag_index.update(gone, notes)
+        self.link_graph.update(gone, notes)
+        index.save()
+        if self.search_index is not None:
+            self.search_index.refresh(self.roots.entries, set(changed) | set(removed))
+            self.search_index.save()
+
+    def dispatch(self, argv, env, out):
+        self.last_request = monotonic()
+        with self.lock:
+            self.run(argv, env, out)
+
+    def run(self, argv, env, out):
+        # traced according to the environment of the client
+        tracing.configure(env)
+        tracing.context.clear()
+        try:
+            args = build_parser().parse_args(argv)
+            if args.action not in SERVED_ACTIONS: return
+            tracing.context['action'] = args.action
+            with span("action", daemon=True):
+                self.answer(args, env, out)
+        except (Exception, SystemExit):
+            log(traceback.format_exc())
+
+    def answer(self, args, env, out):
+        if args.action == "search" and self.search_index is None:
+            self.search_index = SearchIndex(self.roots.primary)
+            self.search_index.load()
+            self.search_index.refresh(self.roots.entries)
+            self.search_index.save()
+        knowit = Knowit(args,
+                        tag_index=self.tag_index,
+                        env=env,
+                        out=out,
+                        preview_cache=self.preview_cache,
+                        search_index=self.search_index,
+                        link_graph=self.link_graph)
+        getattr(knowit, args.action)()
+
+    def serve(self):
+        while monotonic() - self.last_request < self.idle_timeout:
+            self.handle_request()
+
+
+def serve(cwd, idle_timeout, jobs=None, executor="thread"):
+    sock_path = socket_path(cwd)
+    lock_path = f"{sock_path}.lock"
+
+    # only a single daemon per notes directory
+    lock = os_open(lock_path, O_WRONLY | O_CREAT | O_NOFOLLOW, 0o600)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # the lock file was removed by the daemon exiting while we opened it
+        if fstat(lock).st_ino != stat(lock_path).st_ino: raise OSError("stale lock")
+    except OSError:
+        close(lock)
+        return
+
+    if path.exists(sock_path): remove(sock_path) # left over from a dead daemon
+    tracing.context['action'] = "serve"
+    server = KnowitServer(cwd, idle_timeout, jobs=jobs, executor=executor)
+    try:
+        server.serve()
+    finally:
+        for watcher in server.watchers: watcher.stop()
+        server.server_close()
+        remove(sock_path)
+        remove(lock_path)
+        close(lock)
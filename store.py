@@ -0,0 +1,77 @@
+from os import makedirs, replace, remove, listdir, getpid, path
+import fcntl
+import re
+
+from index import INDEX_DIR
+from pack import exists, is_pack, open_pack
+
+COUNTER_FILE = "counter"
+NOTE_NAME = re.compile(r"^(?P<id>\d+)\.md$")
+
+
+def write_atomic(file_path, data):
+    """write data to file_path through a temporary file and a rename"""
+    tmp_path = f"{file_path}.{getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        replace(tmp_path, file_path)
+    except BaseException:
+        if path.exists(tmp_path): remove(tmp_path)
+        raise
+
+
+class NoteStore():
+    """
+    allocates the file names (<id>.md) of new notes in a notes directory.
+
+    the next free id is kept in a counter file, read and bumped under a lock,
+    so allocating is O(1) and two sessions creating notes at the same time
+    never get the same name. the counter is initialized once from the
+    existing names.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.counter_path = path.join(root, INDEX_DIR, COUNTER_FILE)
+
+    def first_free_id(self):
+        names = listdir(self.root)
+        # packed notes keep their names
+        for name in [name for name in names if is_pack(name)]:
+            pack = open_pack(path.join(self.root, name))
+            if pack is not None: names.extend(path.relpath(member, self.root) for member in pack.members)
+        ids = [int(m.group('id')) for m in map(NOTE_NAME.match, names) if m]
+        return max(ids) + 1 if ids else 0
+
+    def allocate(self, count=1):
+        """return the paths of count new notes"""
+        makedirs(path.dirname(self.counter_path), exist_ok=True)
+        with open(f"{self.counter_path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.counter_path, 'r') as f:
+                    next_id = int(f.read().strip())
+            except (OSError, ValueError):
+                next_id = self.first_free_id()
+
+            paths = []
+            while len(paths) < count:
+                note_path = path.join(self.root, f"{next_id}.md")
+                next_id += 1
+                # created behind our back (without the store)
+                if exists(note_path): continue
+                paths.append(note_path)
+
+            write_atomic(self.counter_path, f"{next_id}\n")
+        return paths
+
+    def create_many(self, notes):
+        """
+        write new notes (their path is ignored) in bulk, for importers.
+        return their paths.
+        """
+        paths = self.allocate(len(notes))
+        for note, note_path in zip(notes, paths):
+            note.path = note_path
+            note.dump()
+        return paths
@@ -0,0 +1,123 @@
+from bisect import bisect_left, bisect_right
+
+from tag_query import ALL, evaluate
+
+
+class TagIndex():
+    """
+    inverted index of the notes by tag.
+
+    every tag maps to the set of ids (position in notes) of the notes having
+    it, so "notes having all of these tags" is an intersection of those sets,
+    starting from the rarest tag - proportional to the result and not to the
+    number of notes. any other tag query is evaluated over those sets the
+    same way (see tag_query.evaluate()).
+
+    notes can be updated in place (see update()), a removed note leaves a
+    None in notes so the ids of the others stay valid.
+
+    the notes are also kept by time of creation (order, with their times in
+    times), so results come out oldest first and a time range is a
+    bisection. ids are given by time of creation, as long as no note is
+    added out of order (ordered) the ids alone are in that order.
+    """
+    def __init__(self, notes):
+        self.notes = []
+        self.ids = {}
+        self.postings = {}
+        self.counts = {}
+        self.removed = 0
+        self.order = []
+        self.times = []
+        self.ordered = True
+        for note in sorted(notes, key=lambda note: note.epoch): self.add(note)
+
+    def add(self, note):
+        i = len(self.notes)
+        self.notes.append(note)
+        self.ids[note.path] = i
+        if self.times and note.epoch < self.times[-1]:
+            n = bisect_right(self.times, note.epoch)
+            self.order.insert(n, i)
+            self.times.insert(n, note.epoch)
+            self.ordered = False
+        else:
+            self.order.append(i)
+            self.times.append(note.epoch)
+        for tag in note.tags:
+            if tag not in self.postings:
+                self.postings[tag] = set()
+                self.counts[tag] = 0
+            self.postings[tag].add(i)
+            self.counts[tag] += 1
+
+    def remove(self, note_path):
+        i = self.ids.pop(note_path, None)
+        if i is None: return
+        note = self.notes[i]
+        self.notes[i] = None
+        self.removed += 1
+        n = bisect_left(self.times, note.epoch)
+        while self.order[n] != i: n += 1
+        del self.order[n]
+        del self.times[n]
+        for tag in note.tags:
+            self.postings[tag].discard(i)
+            self.counts[tag] -= 1
+            if not self.counts[tag]:
+                del self.postings[tag]
+                del self.counts[tag]
+
+    def update(self, removed, notes):
+        """remove the notes of the paths in removed, then (re)add notes"""
+        for note_path in removed: self.remove(note_path)
+        for note in notes:
+            self.remove(note.path)
+            self.add(note)
+
+        # compact once most of the ids are dead
+        if self.removed > len(self.ids):
+            self.__init__([note for note in self.notes if note is not None])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def match(self, query, since=None, until=None, last=None):
+        """
+        ids of the notes matching query (see tag_query.parse()), created in
+        [since, until) (epoch seconds, None for no bound) - oldest first.
+        only the last (most recent) of them when last is set.
+        """
+        ids = self.select(query, since, until)
+        if last is not None: ids = ids[max(0, len(ids) - last):]
+        return ids
+
+    def select(self, query, since, until):
+        lo = 0 if since is None else bisect_left(self.times, since)
+        hi = len(self.times) if until is None else bisect_left(self.times, until)
+        if query == ALL:
+            if self.ordered and not self.removed and hi - lo == len(self.notes): return range(lo, hi)
+            return self.order[lo:hi]
+
+        result = evaluate(query, self)
+        if not result: return []
+
+        if hi - lo < len(self.times):
+            # walk the range when it is smaller than the matches
+            if hi - lo <= len(result): return [i for i in self.order[lo:hi] if i in result]
+            first, last = self.times[lo], self.times[hi - 1]
+            result = [i for i in result if first <= self.notes[i].epoch <= last]
+
+        result = sorted(result)
+        if not self.ordered: result.sort(key=lambda i: self.notes[i].epoch)
+        return result
+
+    def facets(self, ids):
+        """count of every tag co-occurring in the notes of ids"""
+        if len(ids) == len(self): return dict(self.counts)
+
+        counts = {}
+        for i in ids:
+            for tag in self.notes[i].tags:
+                counts[tag] = counts.get(tag, 0) + 1
+        return counts
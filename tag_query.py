@@ -0,0 +1,201 @@
+"""
+boolean queries over the tags of the notes, accepted wherever tags are
+selected (-t, the fzf border label, the query prompt):
+
+    #incident (#db OR #cache) NOT #resolved
+    #incident AND (#db | #cache) AND !#resolved
+
+NOT binds tightest, then AND, then OR. tags next to each other are ANDed, so
+a plain list of tags still means all of them. the '#' is optional, and the
+operators are AND/OR/NOT in capitals (or &, |, !) - a tag can be "and".
+
+a query is parsed into nodes, ("tag", name), ("not", node), ("and", nodes)
+or ("or", nodes), and evaluated over the postings of a TagIndex (see
+evaluate()).
+"""
+import re
+
+TOKEN = re.compile(r"\s*(?:(?P<op>[()&|!])|#?(?P<word>[\w\-\.]+))")
+TAG = re.compile(r"[\w\-\.]+")
+OPERATORS = {"AND": "&", "OR": "|", "NOT": "!"}
+
+# the empty query, every note matches it
+ALL = ("and", ())
+
+EMPTY = frozenset()
+
+# checking a note against a query (in python) costs about as much as that
+# many ids of a set operation
+MATCH_COST = 8
+
+
+class QueryError(ValueError):
+    pass
+
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = TOKEN.match(text, pos)
+        if m is None: raise QueryError(f"unexpected {text[pos:].split()[0]!r} in tag query {text!r}")
+        word = m.group('word')
+        tokens.append(m.group('op') if word is None else OPERATORS.get(word, ("tag", word)))
+        pos = m.end()
+    return tokens
+
+
+def parse(terms):
+    """the query of terms - a string, or a list of strings next to each other"""
+    text = terms if isinstance(terms, str) else " ".join(terms)
+    tokens = tokenize(text)
+    node, pos = parse_or(tokens, 0)
+    if pos < len(tokens): raise QueryError(f"unbalanced ')' in tag query {text!r}")
+    return node
+
+
+def parse_or(tokens, pos):
+    nodes = []
+    while True:
+        node, pos = parse_and(tokens, pos)
+        nodes.extend(node[1] if node[0] == "or" else [node])
+        if pos == len(tokens) or tokens[pos] != "|": break
+        pos += 1
+    if len(nodes) == 1: return nodes[0], pos
+    if ALL in nodes: raise QueryError("OR needs a query on both sides")
+    return ("or", tuple(nodes)), pos
+
+
+def parse_and(tokens, pos):
+    nodes = []
+    while pos < len(tokens) and tokens[pos] not in ("|", ")"):
+        if tokens[pos] == "&":
+            pos += 1
+            if not nodes or pos == len(tokens) or tokens[pos] in ("|", ")", "&"):
+                raise QueryError("AND needs a query on both sides")
+            continue
+        node, pos = parse_not(tokens, pos)
+        nodes.extend(node[1] if node[0] == "and" else [node])
+    if len(nodes) == 1: return nodes[0], pos
+    return ("and", tuple(nodes)), pos
+
+
+def parse_not(tokens, pos):
+    token = tokens[pos]
+    if token == "!":
+        if pos + 1 == len(tokens) or tokens[pos + 1] in ("|", ")", "&"): raise QueryError("NOT needs a query")
+        node, pos = parse_not(tokens, pos + 1)
+        return ("not", node), pos
+    if token == "(":
+        node, pos = parse_or(tokens, pos + 1)
+        if pos == len(tokens): raise QueryError("missing ')' in tag query")
+        if node == ALL: raise QueryError("empty '()' in tag query")
+        return node, pos + 1
+    return token, pos + 1
+
+
+def text(node, context="or"):
+    """the query of node as text, parenthesized where context (and/not) binds tighter"""
+    kind = node[0]
+    if kind == "tag": return f"#{node[1]}"
+    if kind == "not": return f"NOT {text(node[1], 'not')}"
+    if kind == "and":
+        string = " ".join(text(child, "and") for child in node[1])
+        return f"({string})" if context == "not" else string
+    string = " OR ".join(text(child, "or") for child in node[1])
+    return string if context == "or" else f"({string})"
+
+
+def is_tag(term):
+    return TAG.fullmatch(term) is not None and term not in OPERATORS
+
+
+def terms(label):
+    """
+    the terms ANDed at the top of the query text label: a tag (its name), or
+    the text of any other query. the border label of fzf is kept as those.
+    """
+    node = parse(label)
+    nodes = node[1] if node[0] == "and" else (node,)
+    return [n[1] if n[0] == "tag" else text(n, "and") for n in nodes]
+
+
+def label(terms):
+    """the query text of terms (see terms())"""
+    return " ".join(f"#{term}" if is_tag(term) else term for term in terms)
+
+
+def tags(node):
+    """the tags the notes matching node have (not those under a NOT)"""
+    kind = node[0]
+    if kind == "tag": return [node[1]]
+    if kind == "not": return []
+    return [tag for child in node[1] for tag in tags(child)]
+
+
+def matches(node, note_tags):
+    kind = node[0]
+    if kind == "tag": return node[1] in note_tags
+    if kind == "not": return not matches(node[1], note_tags)
+    if kind == "and": return all(matches(child, note_tags) for child in node[1])
+    return any(matches(child, note_tags) for child in node[1])
+
+
+def estimate(node, index):
+    """estimated number of notes of index matching node"""
+    kind = node[0]
+    if kind == "tag": return index.counts.get(node[1], 0)
+    if kind == "not": return len(index) - estimate(node[1], index)
+    if kind == "and": return min((estimate(child, index) for child in node[1]), default=len(index))
+    return min(len(index), sum(estimate(child, index) for child in node[1]))
+
+
+def work(node, index):
+    """cost of building the set of node, about the number of ids touched"""
+    kind = node[0]
+    if kind == "tag": return index.counts.get(node[1], 0)
+    if kind == "not": return len(index) + work(node[1], index)
+    return sum(work(child, index) for child in node[1])
+
+
+def size(node):
+    """number of tags in node, the cost of matching one note against it"""
+    if node[0] == "tag": return 1
+    if node[0] == "not": return size(node[1])
+    return sum(size(child) for child in node[1])
+
+
+def evaluate(node, index):
+    """
+    the ids of the notes of index (a TagIndex) matching node, as a set not
+    to be modified.
+
+    the operands of an AND go from the smallest (estimated) to the largest,
+    so the intermediate result only shrinks - and it stops once it is empty.
+    an operand costing more to build than checking the notes left one by one
+    is checked note by note instead, so a complex query narrowed by a rare
+    tag costs about the same as the rare tag alone.
+    """
+    kind = node[0]
+    if kind == "tag": return index.postings.get(node[1], EMPTY)
+    if kind == "not": return set(index.ids.values()) - evaluate(node[1], index)
+    if kind == "or": return set().union(*[evaluate(child, index) for child in node[1]])
+
+    children = sorted(node[1], key=lambda child: estimate(child, index))
+    if not children: return set(index.ids.values())
+    result = evaluate(children[0], index)
+    for child in children[1:]:
+        if not result: break
+        negated = child[1] if child[0] == "not" else None
+        if child[0] == "tag":
+            result = result & index.postings.get(child[1], EMPTY)
+        elif negated is not None and negated[0] == "tag":
+            result = result - index.postings.get(negated[1], EMPTY)
+        elif len(result) * size(child) * MATCH_COST < work(negated or child, index):
+            result = {i for i in result if matches(child, index.notes[i].tags)}
+        elif negated is not None:
+            result = result - evaluate(negated, index)
+        else:
+            result = result & evaluate(child, index)
+    return result
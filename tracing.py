@@ -0,0 +1,136 @@
+"""
+opt-in timing spans, enabled by the KNOWIT_TRACE environment variable - so
+it is inherited by everything fzf spawns, and client.py forwards it to the
+daemon.
+
+KNOWIT_TRACE is the file the spans are appended to, any value without a '/'
+(e.g. 1) uses TRACE_FILE. a span is a json line -
+
+    {"span": "parse", "action": "fzf_reload", "notes": 1200, "pid": 42,
+     "start": 1700000000.123456, "ms": 12.5, "files": 3}
+
+the spans: action (the whole action), client (round trip to the daemon),
+load, walk, parse, filter, render, subprocess and http.
+`knowit.py -a stats` summarizes them.
+"""
+from os import environ, getuid, getpid
+from time import perf_counter, time
+import os
+import json
+
+TRACE_ENV = "KNOWIT_TRACE"
+TRACE_FILE = f"/tmp/knowit-trace-{getuid()}.ndjson"
+
+# fields of every span (action, notes), filled in as they become known
+context = {}
+
+_path = None
+
+
+def trace_path(env=environ):
+    value = env.get(TRACE_ENV)
+    if not value or value == "0": return None
+    return value if "/" in value else TRACE_FILE
+
+
+def configure(env=environ):
+    """trace according to env (the daemon does it per request)"""
+    global _path
+    _path = trace_path(env)
+
+
+class Span():
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.start = time()
+        self.begin = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        ms = (perf_counter() - self.begin) * 1000
+        record = {"span": self.name}
+        record.update(context)
+        record.update(self.fields)
+        record.update({"pid": getpid(), "start": round(self.start, 6), "ms": round(ms, 3)})
+        if exc_type is not None: record["error"] = exc_type.__name__
+        emit(record)
+        return False
+
+
+class NullSpan():
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, **fields):
+    """with span("parse", files=10) as s: ... - free when tracing is off"""
+    if _path is None: return NULL_SPAN
+    return Span(name, fields)
+
+
+def emit(record):
+    # a single O_APPEND write per line, so concurrent processes don't mix lines
+    try:
+        fd = os.open(_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(record) + "\n").encode())
+        finally:
+            os.close(fd)
+    except (OSError, TypeError):
+        pass
+
+
+def percentile(values, p):
+    """nearest rank percentile of sorted values"""
+    rank = -(-p * len(values) // 100) # ceil
+    return values[max(0, rank - 1)]
+
+
+def stats(file_path):
+    """rows of (action, span, count, p50, p90, p99, max) of the spans in file_path"""
+    durations = {}
+    with open(file_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            key = (record.get('action') or "-", record.get('span') or "-")
+            durations.setdefault(key, []).append(record.get('ms', 0))
+
+    rows = []
+    for (action, name), values in sorted(durations.items()):
+        values.sort()
+        rows.append((action, name, len(values),
+                     percentile(values, 50), percentile(values, 90),
+                     percentile(values, 99), values[-1]))
+    return rows
+
+
+def print_stats(file_path, out):
+    try:
+        rows = stats(file_path)
+    except OSError:
+        out.write(f"no trace at {file_path} (set {TRACE_ENV} to record one)\n")
+        return
+    out.write(f"{'action':<12} {'span':<10} {'count':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}\n")
+    for action, name, count, p50, p90, p99, top in rows:
+        out.write(f"{action:<12} {name:<10} {count:>7} {p50:>9.2f} {p90:>9.2f} {p99:>9.2f} {top:>9.2f}\n")
+
+
+configure()
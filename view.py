@@ -0,0 +1,93 @@
+"""
+the view file: a header line with the tag query of the view, followed by a
+block per note -
+
+    \n
+    ---\n
+    <note path>\n
+    \n
+    ---\n
+    <the lines of the note file>
+
+a sidecar (in .knowit/views) keeps the hash and stat of every note as it was
+put in the view, that's the base sync() compares both sides against.
+"""
+from os import makedirs, replace, getpid, path
+from hashlib import sha1
+import json
+import re
+
+from index import INDEX_DIR
+import tag_query
+
+VIEWS_DIR = "views"
+
+NOTE_HEADER = re.compile(r"^\[\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d\]")
+
+
+def terminated(lines):
+    """the lines of a note as they are in the view, the view adds a missing final newline"""
+    if lines and not lines[-1].endswith("\n"): return lines[:-1] + [lines[-1] + "\n"]
+    return lines
+
+
+def content_hash(lines):
+    """hash of the (decoded) lines of a note, as they are in the view"""
+    return sha1("".join(terminated(lines)).encode()).hexdigest()
+
+
+def block_header(note_path):
+    return ["\n", "---\n", f"{note_path}\n", "\n", "---\n"]
+
+
+def is_block_start(lines, i):
+    """lines[i:i+5] is the header of a note block (followed by the note header)"""
+    if i + 6 > len(lines): return False
+    if lines[i] != "\n" or lines[i + 1] != "---\n": return False
+    if lines[i + 3] != "\n" or lines[i + 4] != "---\n": return False
+    note_path = lines[i + 2].strip()
+    if not note_path or note_path.startswith("["): return False
+    return NOTE_HEADER.match(lines[i + 5]) is not None
+
+
+def parse_view(lines):
+    """return the tags (tag query terms) of the view and its [(note path, note lines)] blocks"""
+    if not lines: return [], []
+    tags = tag_query.terms(lines[0].split("]", 1)[-1])
+
+    starts = [i for i in range(1, len(lines)) if is_block_start(lines, i)]
+    blocks = []
+    for n, start in enumerate(starts):
+        end = starts[n + 1] if n + 1 < len(starts) else len(lines)
+        blocks.append((lines[start + 2].strip(), lines[start + 5:end]))
+    return tags, blocks
+
+
+def state_path(cwd, view_path):
+    digest = sha1(path.abspath(view_path).encode()).hexdigest()
+    return path.join(cwd, INDEX_DIR, VIEWS_DIR, f"{digest}.json")
+
+
+def load_state(cwd, view_path):
+    """{note path: {'hash': ..., 'stat': [mtime, size, inode]}} of the view"""
+    try:
+        with open(state_path(cwd, view_path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(cwd, view_path, state):
+    file_path = state_path(cwd, view_path)
+    try:
+        makedirs(path.dirname(file_path), exist_ok=True)
+        tmp_path = f"{file_path}.{getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        replace(tmp_path, file_path)
+    except OSError:
+        pass
+
+
+def stat_key(st):
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
@@ -0,0 +1,197 @@
+from os import read, close, path, scandir
+from threading import Thread, Event, Lock
+import select
+import struct
+
+from index import INDEX_DIR
+
+# quiet time (seconds) before a burst of events is handed over, so the many
+# writes of an editor saving a file (swap files, backups, renames) cost one
+# update
+COALESCE_DELAY = 0.2
+
+# re-validation interval (seconds) of the polling fallback
+POLL_INTERVAL = 2.0
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+
+EVENT = struct.Struct("iIII")
+
+
+def load_libc():
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+class InotifyWatcher(Thread):
+    """
+    watches every directory under root with inotify, and calls
+    on_change(paths) with the set of paths that were created, modified,
+    deleted or renamed - once per burst of events.
+    on_change(None) means everything should be re-validated (the kernel
+    queue overflowed).
+    """
+    def __init__(self, root, on_change, delay=COALESCE_DELAY):
+        super().__init__(daemon=True)
+        self.root = root
+        self.on_change = on_change
+        self.delay = delay
+        self.stopped = Event()
+        self.libc = load_libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0: raise OSError("inotify_init1 failed")
+        self.dirs = {}
+        self.add_tree(root)
+
+    def add_tree(self, top):
+        """watch top and every directory under it, return the files found"""
+        files = []
+        dirs = [top]
+        while dirs:
+            current = dirs.pop()
+            wd = self.libc.inotify_add_watch(self.fd, current.encode(), WATCH_MASK)
+            if wd < 0: continue
+            self.dirs[wd] = current
+            try:
+                with scandir(current) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name != INDEX_DIR: dirs.append(entry.path)
+                        else:
+                            files.append(entry.path)
+            except OSError:
+                continue
+        return files
+
+    def stop(self):
+        self.stopped.set()
+
+    def events(self):
+        try:
+            data = read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="surrogateescape")
+            offset += length
+            yield wd, mask, name
+
+    def run(self):
+        pending = set()
+        try:
+            while not self.stopped.is_set():
+                timeout = self.delay if pending else 1.0
+                ready, _, _ = select.select([self.fd], [], [], timeout)
+                if not ready:
+                    if pending:
+                        self.on_change(None if None in pending else pending)
+                        pending = set()
+                    continue
+
+                for wd, mask, name in self.events():
+                    if mask & IN_Q_OVERFLOW:
+                        pending.add(None)
+                        continue
+                    if mask & IN_IGNORED:
+                        self.dirs.pop(wd, None)
+                        continue
+                    directory = self.dirs.get(wd)
+                    if directory is None or not name: continue
+                    if name == INDEX_DIR and directory == self.root: continue
+
+                    event_path = path.join(directory, name)
+                    pending.add(event_path)
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        # files may land in it before its watch is added
+                        pending.update(self.add_tree(event_path))
+        finally:
+            close(self.fd)
+
+
+class PollingWatcher(Thread):
+    """fallback when inotify is not available, re-validates everything every interval"""
+    def __init__(self, root, on_change, interval=POLL_INTERVAL):
+        super().__init__(daemon=True)
+        self.root = root
+        self.on_change = on_change
+        self.interval = interval
+        self.stopped = Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.on_change(None)
+
+
+def Watcher(root, on_change):
+    """inotify watcher on linux, polling anywhere else"""
+    try:
+        return InotifyWatcher(root, on_change)
+    except (OSError, AttributeError):
+        return PollingWatcher(root, on_change)
+
+
+def watch(cwd, jobs=None, executor="thread"):
+    """keep the on-disk indexes of the roots of cwd up to date until interrupted"""
+    from roots import Roots
+    from search import SearchIndex
+
+    roots = Roots(cwd, jobs=jobs, executor=executor)
+    roots.refresh()
+
+    # the search index is only maintained if it is in use
+    search_index = SearchIndex(roots.primary)
+    if path.exists(search_index.path):
+        search_index.load()
+        search_index.refresh(roots.entries)
+        search_index.save()
+    else:
+        search_index = None
+
+    # the watchers of the roots share the search index
+    lock = Lock()
+
+    def on_change(index, paths):
+        with lock:
+            if paths is None:
+                changed, removed = index.refresh()
+            else:
+                changed, removed = index.update(paths)
+            index.save()
+            if search_index is not None and (changed or removed):
+                search_index.refresh(roots.entries, set(changed) | set(removed))
+                search_index.save()
+
+    watchers = [Watcher(index.root, lambda paths, index=index: on_change(index, paths))
+                for index in roots.indexes]
+    for watcher in watchers: watcher.start()
+    try:
+        while any(watcher.is_alive() for watcher in watchers):
+            for watcher in watchers: watcher.join(1)
+    except KeyboardInterrupt:
+        for watcher in watchers: watcher.stop()